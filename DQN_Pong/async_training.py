@@ -0,0 +1,197 @@
+import the_agent
+import environment
+from frame_stack import FrameStack
+from agent_memory import ShardedMemory
+from scheduler import Scheduler
+from loggers import MetricsWriter, saveTrainingConfig
+import multiprocessing as mp
+import numpy as np
+import queue
+import time
+
+
+class SharedWeights():
+    """The learner's latest weights and epsilon in shared memory, with a version
+    number the actors compare against to know when to pull a new copy"""
+    def __init__(self, weights, context):
+        self.shapes = [w.shape for w in weights]
+        self.buffer = context.RawArray('f', int(sum(w.size for w in weights)))
+        self.version = context.Value('q', 0)
+        self.epsilon = context.Value('d', 1.0)
+        self.lock = context.Lock()
+
+    def publish(self, weights, epsilon):
+        flat = np.frombuffer(self.buffer, dtype=np.float32)
+        with self.lock:
+            offset = 0
+            for w in weights:
+                flat[offset:offset + w.size] = w.ravel()
+                offset += w.size
+            self.epsilon.value = epsilon
+            self.version.value += 1
+
+    def pull(self, agent):
+        """Copy the published weights and epsilon into agent, returns their version"""
+        flat = np.frombuffer(self.buffer, dtype=np.float32)
+        weights = []
+        with self.lock:
+            offset = 0
+            for shape in self.shapes:
+                size = int(np.prod(shape))
+                weights.append(flat[offset:offset + size].reshape(shape).copy())
+                offset += size
+            agent.epsilon = self.epsilon.value
+            version = self.version.value
+        agent.model.set_weights(weights)
+        return version
+
+
+def run_actor(actor_id, config, memory, weights, stop, episodes, timesteps):
+    """Play episodes into this actor's replay shard, never learning. Pulls new weights
+    every actor_sync_steps steps if the learner has published since the last pull.
+    Every step is added to timesteps, the env steps of all actors together"""
+    try:
+        # starting_mem_len above max_mem_len: take_step never calls learn
+        agent = the_agent.Agent(config['possible_actions']\
+                                ,memory.max_len + 1\
+                                ,memory.max_len\
+                                ,config['starting_epsilon']\
+                                ,config['learn_rate']\
+                                ,memory=memory)
+        env = environment.make_env(config['name'], agent)
+        frame_stack = FrameStack()
+        while weights.version.value == 0 and not stop.is_set():
+            time.sleep(.1)
+        version = 0
+        while not stop.is_set():
+            time_elapsed = time.time()
+            environment.initialize_new_game(config['name'], env, agent, frame_stack)
+            score = 0
+            steps = 0
+            done = False
+            while not done and not stop.is_set():
+                if steps % config['actor_sync_steps'] == 0 and weights.version.value != version:
+                    version = weights.pull(agent)
+                score, done = environment.take_step(config['name'], env, agent, score, False, None, frame_stack)
+                steps += 1
+                with timesteps.get_lock():
+                    timesteps.value += 1
+            if done:
+                episodes.put((actor_id, score, steps, time.time() - time_elapsed, agent.epsilon))
+    except KeyboardInterrupt:
+        pass
+
+def run_learner(config, shards, weights, stop, learns, timesteps, modelFilename, saved):
+    """Train on the actors' shards as fast as it can, publishing weights every
+    weights_publish_interval learns and saving the model every model_save_interval,
+    and once more when it stops. saved is set once the starting weights are saved.
+    Epsilon follows the actors' steps in timesteps when it decays per 'steps'"""
+    agent = None
+    try:
+        agent = the_agent.Agent(config['possible_actions']\
+                                ,config['starting_mem_len']\
+                                ,config['max_mem_len']\
+                                ,config['starting_epsilon']\
+                                ,config['learn_rate']\
+                                ,memory=ShardedMemory(shards,seed=config['replay_seed'])\
+                                ,scheduler=Scheduler.from_config(config)\
+                                ,prefetch=config['prefetch_batches'] > 0)
+        weights.pull(agent) # start from the session's model
+        agent.model.save(modelFilename)
+        saved.set()
+        agent.learns = int(config['learns'])
+        agent.total_timesteps = timesteps.value
+        agent.update_epsilon()
+        while not stop.is_set():
+            if len(agent.memory) <= agent.starting_mem_len:
+                time.sleep(.1)
+                continue
+            previous_learns = agent.learns
+            agent.total_timesteps = timesteps.value # learn updates epsilon
+            agent.learn()
+            learns.value = agent.learns
+            if agent.learns // config['weights_publish_interval'] != previous_learns // config['weights_publish_interval']:
+                weights.publish(agent.model.get_weights(), agent.epsilon)
+            if agent.learns // config['model_save_interval'] != previous_learns // config['model_save_interval']:
+                agent.model.save(modelFilename)
+    except KeyboardInterrupt: # Ctrl-C reaches the learner too
+        pass
+    finally:
+        if agent is not None:
+            agent.model.save(modelFilename)
+
+def train(config, agent, sessionId, configFilename, historyFilename, modelFilename):
+    """main.train for num_actors > 0: actor processes play with periodically synced
+    weights into shared-memory replay shards while a learner process trains on them.
+    agent only supplies the starting weights, the learner builds its own copy.
+    The learner saves model_<id> rather than checkpoints, so once it has saved the
+    starting weights the config stops pointing at a checkpoint and either trainer
+    resumes from the model"""
+    context = mp.get_context('spawn')
+    weights = SharedWeights(agent.model.get_weights(), context)
+    # agent has the default scheduler, the session's decides the resumed epsilon
+    epsilon = Scheduler.from_config(config).epsilon(int(config['learns']), int(config['total_timesteps']))
+    weights.publish(agent.model.get_weights(), epsilon)
+    shards = agent.memory.shards
+    stop = context.Event()
+    episodes = context.Queue()
+    learns = context.Value('q', int(config['learns']))
+    timesteps = context.Value('q', int(config['total_timesteps']))
+    saved = context.Event()
+
+    processes = [context.Process(target=run_learner, args=(config, shards, weights, stop, learns, timesteps, modelFilename, saved))]
+    for actor_id in range(config['num_actors']):
+        processes.append(context.Process(target=run_actor, args=(actor_id, config, shards[actor_id], weights, stop, episodes, timesteps)))
+    for process in processes:
+        process.start()
+
+    max_score = -21
+    i = int(config['episode_number'])
+    last_learns = int(config['learns'])
+    last_time = time.time()
+    history = MetricsWriter(historyFilename,config['history_flush_rows'],config['history_flush_seconds'])
+    try:
+        while True:
+            if not all(process.is_alive() for process in processes):
+                print('Error: an actor or the learner stopped')
+                return
+            try:
+                actor_id, score, steps, duration, epsilon = episodes.get(timeout=10)
+            except queue.Empty:
+                continue
+            if score > max_score:
+                max_score = score
+            learner_steps_per_sec = (learns.value - last_learns) / (time.time() - last_time)
+            last_learns = learns.value
+            last_time = time.time()
+
+            episodeData = {
+                'sessionId': sessionId
+            ,   'episode_number': i
+            ,   'steps': steps
+            ,   'duration': duration
+            ,   'score': score
+            ,   'max_score': max_score
+            ,   'epsilon': epsilon
+            ,   'actor': actor_id
+            ,   'actor_steps_per_sec': steps / duration
+            ,   'learns': learns.value
+            ,   'learner_steps_per_sec': learner_steps_per_sec
+            }
+            print(episodeData)
+
+            history.write(episodeData) # save history
+            config['episode_number'] = str(i)
+            config['learns'] = learns.value
+            config['total_timesteps'] = timesteps.value
+            if saved.is_set():
+                config.pop('checkpoint', None)
+            saveTrainingConfig(config,configFilename) # saveConfig
+            i += 1
+    finally:
+        history.close() # write the rows still held, also when interrupted
+        stop.set()
+        for process in processes:
+            process.join(timeout=60)
+        for shard in shards:
+            shard.unlink()
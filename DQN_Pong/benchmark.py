@@ -0,0 +1,217 @@
+"""Offline throughput benchmarks for the hot paths of both agents, on FakePong frames
+so no Atari ROMs are needed. Each benchmark is timed over several rounds and the
+median time per call is kept. Results go to a json file which a later run can be
+compared against:
+
+    python benchmark.py --out before.json
+    python benchmark.py --out after.json --compare before.json
+
+--compare exits with status 1 if any benchmark got slower than --tolerance allows"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+import preprocess_frame as ppf
+import environment
+from agent_memory import Memory
+from frame_stack import FrameStack
+from fake_pong import FakePong
+import the_agent
+import numpy_inference
+
+
+def measure(function, min_time = .5, rounds = 5):
+    """Median and best time in microseconds per call of function, over rounds that
+    each call it for at least min_time seconds"""
+    calls = 1
+    while True: # find how many calls take about min_time
+        start = time.perf_counter()
+        for i in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        calls *= 2
+    calls = max(1, int(calls * min_time / elapsed))
+    times = []
+    for repeat in range(rounds):
+        start = time.perf_counter()
+        for i in range(calls):
+            function()
+        times.append((time.perf_counter() - start) / calls * 1e6)
+    return {'us_per_call': float(np.median(times)), 'best_us_per_call': float(min(times)), 'calls_per_round': calls}
+
+def fake_frames(count, seed = 0):
+    env = FakePong(seed)
+    return np.stack([env.step(0)[0] for i in range(count)])
+
+def filled_memory(size, seed = 0):
+    memory = Memory(size, seed = seed)
+    frames = ppf.resize_frames(fake_frames(1000, seed))
+    for i in range(size):
+        memory.add_experience(frames[i % 1000], float(i % 60 == 0), 2, i % 1300 == 1299)
+    return memory
+
+def dqn_benchmarks(min_time):
+    results = {}
+    frames = fake_frames(64)
+    results['resize_frame'] = measure(lambda: ppf.resize_frame(frames[0]), min_time)
+    results['resize_frames_x8'] = measure(lambda: ppf.resize_frames(frames[:8]), min_time)
+
+    memory = Memory(100000, seed = 0)
+    frame = ppf.resize_frame(frames[0])
+    results['memory_add_experience'] = measure(lambda: memory.add_experience(frame, 0., 2, False), min_time)
+
+    agent = the_agent.Agent([0,2,3], 5000, 20000, 0, .00025, memory = filled_memory(20000))
+    state = FrameStack().state
+    state[:] = frame[...,None]
+    results['get_action_greedy'] = measure(lambda: agent.get_action(state), min_time)
+    network = numpy_inference.from_weights(agent.model.get_weights())
+    results['numpy_q_values'] = measure(lambda: network(state), min_time)
+    results['learn_batch_assembly'] = measure(lambda: agent._sample_batch(), min_time)
+    agent.learn() # traces the train step
+    results['learn'] = measure(agent.learn, min_time * 4, rounds = 3)
+
+    env = FakePong()
+    agent = the_agent.Agent([0,2,3], 10**9, 20000, 1, .00025) # explores, never learns
+    frame_stack = FrameStack()
+    environment.initialize_new_game('FakePong', env, agent, frame_stack)
+    def step():
+        score, done = environment.take_step('FakePong', env, agent, 0, False, None, frame_stack)
+        if done:
+            environment.initialize_new_game('FakePong', env, agent, frame_stack)
+    results['take_step_exploring'] = measure(step, min_time)
+    return results
+
+def rl_nn_benchmarks(min_time):
+    """RL_NN/main.py is a script of its own, loaded by path next to DQN_Pong's main"""
+    spec = importlib.util.spec_from_file_location('rl_nn_main', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RL_NN', 'main.py'))
+    rl_nn = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(rl_nn)
+    rng = np.random.default_rng(0)
+    weights = {'1': rng.standard_normal((200, 6400)) / np.sqrt(6400), '2': rng.standard_normal(200) / np.sqrt(200)}
+
+    results = {}
+    frames = fake_frames(2)
+    previous = rl_nn.preprocess_observations(frames[0].copy(), None, 6400)[1]
+    results['rl_nn_preprocess_observations'] = measure(lambda: rl_nn.preprocess_observations(frames[1].copy(), previous, 6400), min_time)
+    observation = rl_nn.preprocess_observations(frames[1].copy(), previous, 6400)[0]
+    results['rl_nn_neural_net'] = measure(lambda: rl_nn.neural_net(observation, weights), min_time)
+
+    steps = 1000 # about one game point's worth of an episode
+    observations = np.stack([rl_nn.preprocess_observations(frame.copy(), None, 6400)[1] for frame in fake_frames(steps)])
+    hidden = np.maximum(observations @ weights['1'].T, 0)
+    gradient_log_p = rng.standard_normal((steps, 1))
+    rewards = np.zeros((steps, 1))
+    rewards[59::60] = 1
+    results['rl_nn_compute_gradient_1000_steps'] = measure(lambda: rl_nn.compute_gradient(gradient_log_p, hidden, observations, weights), min_time)
+    episode = rl_nn.EpisodeBuffer(6400, 200)
+    sparse_episode = rl_nn.EpisodeBuffer(6400, 200, sparse = True)
+    previous = None
+    for step, frame in enumerate(fake_frames(steps)):
+        difference, previous = rl_nn.preprocess_observations(frame.copy(), previous, 6400)
+        episode.append(difference, hidden[step], gradient_log_p[step], rewards[step])
+        sparse_episode.append(rl_nn.sparse_observation(difference), hidden[step], gradient_log_p[step], rewards[step])
+    sparse = rl_nn.sparse_observation(observation)
+    results['rl_nn_neural_net_sparse'] = measure(lambda: rl_nn.neural_net_sparse([sparse], weights), min_time)
+    results['rl_nn_compute_gradient_int8_1000_steps'] = measure(lambda: rl_nn.compute_gradient(gradient_log_p, hidden, episode.observations(), weights), min_time)
+    results['rl_nn_compute_gradient_sparse_1000_steps'] = measure(lambda: rl_nn.compute_gradient_sparse(gradient_log_p, hidden, sparse_episode.observations(), weights), min_time)
+    results['rl_nn_discount_rewards_1000_steps'] = measure(lambda: rl_nn.discount_rewards(rewards, .99), min_time)
+    for envs in (1, 2, 4, 8, 16):
+        results['rl_nn_lockstep_%d_envs' % envs] = rl_nn_lockstep(rl_nn, weights, envs)
+    return results
+
+def rl_nn_lockstep(rl_nn, weights, envs, episodes_per_env = 2):
+    """RL_NN's training loop with envs FakePongs in lockstep, learning from each episode
+    as it ends. us_per_call is per env step, episodes_per_hour counts every env"""
+    games = [FakePong(i, points_per_game = 5) for i in range(envs)] # 300 step episodes
+    observations = [game.reset() for game in games]
+    previous = [None] * envs
+    episodes = [rl_nn.EpisodeBuffer(6400, 200) for i in range(envs)]
+    finished = 0
+    start = time.perf_counter()
+    while finished < envs * episodes_per_env:
+        processed = []
+        for i in range(envs):
+            observation, previous[i] = rl_nn.preprocess_observations(observations[i], previous[i], 6400)
+            processed.append(observation)
+        hidden, up_probabilities = rl_nn.neural_net(np.vstack(processed), weights)
+        for i, game in enumerate(games):
+            action = rl_nn.Move_up_or_down(up_probabilities[i])
+            observations[i], reward, done, info = game.step(action)
+            episodes[i].append(processed[i], hidden[i], (action == 2) - up_probabilities[i], reward)
+            if done:
+                rl_nn.episode_gradient(episodes[i], weights, .99)
+                episodes[i].clear()
+                observations[i] = game.reset()
+                previous[i] = None
+                finished += 1
+    elapsed = time.perf_counter() - start
+    return {'us_per_call': elapsed / (300 * finished) * 1e6, 'episodes_per_hour': finished / elapsed * 3600, 'envs': envs}
+
+def machine():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit
+    ,   'datetime': time.strftime('%Y-%m-%d %H:%M:%S')
+    ,   'platform': platform.platform()
+    ,   'processor': platform.processor()
+    ,   'cpu_count': os.cpu_count()
+    ,   'python': platform.python_version()
+    ,   'numpy': np.__version__
+    ,   'tensorflow': tf.__version__
+    }
+
+def compare(results, baseline, tolerance):
+    """Print each benchmark's time against the baseline's, returns the names that got
+    slower by more than tolerance"""
+    regressions = []
+    print('%-36s %12s %12s %8s' % ('benchmark', 'before us', 'after us', 'ratio'))
+    for name, result in results.items():
+        if name not in baseline:
+            print('%-36s %12s %12.1f' % (name, '-', result['us_per_call']))
+            continue
+        ratio = result['us_per_call'] / baseline[name]['us_per_call']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  slower'
+        print('%-36s %12.1f %12.1f %8.2f%s' % (name, baseline[name]['us_per_call'], result['us_per_call'], ratio, flag))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Offline benchmarks of the DQN and RL_NN hot paths')
+    parser.add_argument('--out', default = 'benchmark.json', help = 'where to write the results')
+    parser.add_argument('--compare', help = 'results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type = float, default = .1, help = 'slowdown allowed by --compare, .1 is 10%%')
+    parser.add_argument('--min-time', type = float, default = .5, help = 'seconds each round of a benchmark runs for')
+    parser.add_argument('--only', choices = ['dqn', 'rl_nn'], help = 'run one of the two groups')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    tf.random.set_seed(0)
+    results = {}
+    if args.only != 'rl_nn':
+        results.update(dqn_benchmarks(args.min_time))
+    if args.only != 'dqn':
+        results.update(rl_nn_benchmarks(args.min_time))
+    with open(args.out, 'w') as file:
+        json.dump({'machine': machine(), 'results': results}, file, indent = 2)
+    for name, result in results.items():
+        print('%-36s %12.1f us' % (name, result['us_per_call']) + ('  %8.0f episodes/hour' % result['episodes_per_hour'] if 'episodes_per_hour' in result else ''))
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        print('\nAgainst ' + args.compare + ' (commit ' + str(baseline['machine']['commit']) + ')')
+        if compare(results, baseline['results'], args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,165 @@
+import contextlib
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import numpy as np
+
+
+class CheckpointManager():
+    """Snapshots the agent in memory on the training thread and writes it on a background
+    thread, so training only pays for copying the weights. A checkpoint is a folder
+    ckpt_<total_timesteps> holding the model and target weights, optionally the optimizer
+    state and a replay snapshot, and the session config. One saved again without new env
+    steps gets a _<n> suffix, the one the config points at is never replaced. It is written
+    under a temporary name, synced to disk and renamed when complete, and only then is the
+    session config, which resume reads, replaced (also by rename) to point at it. A crash mid-write leaves the last
+    complete checkpoint in charge. The newest keep checkpoints are kept.
+    A save asked for while the previous one is still being written is skipped"""
+    def __init__(self, folder, config, configFilename, keep = 3, every_episodes = 1, every_seconds = 0\
+                , include_optimizer = True, include_replay = False):
+        self.folder = folder
+        self.config = config
+        self.configFilename = configFilename
+        self.keep = keep
+        self.every_episodes = every_episodes
+        self.every_seconds = every_seconds
+        self.include_optimizer = include_optimizer
+        self.include_replay = include_replay
+        os.makedirs(folder, exist_ok = True)
+        for name in os.listdir(folder): # left by a crash mid-write
+            if name.endswith('.tmp'):
+                shutil.rmtree(os.path.join(folder, name))
+        self.last_episode = int(config['episode_number']) - 1
+        self.last_time = time.time()
+        self.pending = queue.Queue()
+        self.idle = threading.Event() # clear while a checkpoint is being written
+        self.idle.set()
+        self.error = None
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def checkpoints(self):
+        """Names of the complete checkpoints, oldest first"""
+        return sorted(name for name in os.listdir(self.folder) if name.startswith('ckpt_') and not name.endswith('.tmp'))
+
+    def due(self, episode):
+        return (self.every_episodes > 0 and episode - self.last_episode >= self.every_episodes)\
+            or (self.every_seconds > 0 and time.time() - self.last_time >= self.every_seconds)
+
+    def save(self, agent, wait = False):
+        """Snapshot agent and the config and queue them for writing. Returns False if the
+        previous checkpoint is still being written, unless wait is set"""
+        if self.error is not None:
+            raise self.error
+        if not self.idle.is_set() and not wait:
+            return False
+        self.idle.wait()
+        config = self.config
+        config['learns'] = agent.learns
+        config['total_timesteps'] = agent.total_timesteps
+        if config['replay_backend'] == 'memmap':
+            agent.memory.flush() # frames hit the disk before the config points at them
+            config['replay_index'] = int(agent.memory.index)
+            config['replay_count'] = int(agent.memory.count)
+        name = 'ckpt_%012d' % agent.total_timesteps
+        same = [existing for existing in self.checkpoints() if existing.startswith(name)]
+        if len(same) > 0: # saved again without new env steps, sort after the earlier ones
+            name = '%s_%03d' % (name, int(same[-1][len(name) + 1:] or 0) + 1)
+        snapshot = {
+            'name': name
+        ,   'config': json.loads(json.dumps(dict(config, checkpoint = name)))
+        ,   'model': agent.model.get_weights()
+        ,   'model_target': agent.model_target.get_weights()
+        }
+        if self.include_optimizer:
+            snapshot['optimizer'] = [variable.numpy() for variable in agent.model.optimizer.variables]
+        if self.include_replay:
+            snapshot['replay'] = agent.memory.snapshot()
+        self.idle.clear()
+        self.pending.put(snapshot)
+        self.last_episode = int(config['episode_number'])
+        self.last_time = time.time()
+        return True
+
+    def _run(self):
+        while True:
+            snapshot = self.pending.get()
+            if snapshot is None:
+                return
+            try:
+                self._write(snapshot)
+            except Exception as error:
+                self.error = error # raised by the next save on the training thread
+            self.idle.set()
+
+    def _write(self, snapshot):
+        path = os.path.join(self.folder, snapshot['name'])
+        temporary = path + '.tmp'
+        os.makedirs(temporary)
+        with _synced(os.path.join(temporary, 'model.npz')) as file:
+            np.savez(file, *snapshot['model'])
+        with _synced(os.path.join(temporary, 'model_target.npz')) as file:
+            np.savez(file, *snapshot['model_target'])
+        if 'optimizer' in snapshot:
+            with _synced(os.path.join(temporary, 'optimizer.npz')) as file:
+                np.savez(file, *snapshot['optimizer'])
+        if 'replay' in snapshot:
+            with _synced(os.path.join(temporary, 'replay.npz')) as file:
+                np.savez(file, **snapshot['replay'])
+        with _synced(os.path.join(temporary, 'config.json'), 'w') as file:
+            json.dump(snapshot['config'], file)
+        os.rename(temporary, path)
+
+        with _synced(self.configFilename + '.tmp', 'w') as file:
+            file.write(json.dumps(snapshot['config']) + "\n")
+        os.replace(self.configFilename + '.tmp', self.configFilename)
+
+        for name in self.checkpoints()[:-self.keep]:
+            shutil.rmtree(os.path.join(self.folder, name))
+
+    def restore(self, agent, name):
+        """Load checkpoint name into agent. The config was already read from the session"""
+        path = os.path.join(self.folder, name)
+        agent.model.set_weights(load_model_weights(path))
+        agent.model_target.set_weights(_load_arrays(os.path.join(path, 'model_target.npz')))
+        if os.path.exists(os.path.join(path, 'optimizer.npz')):
+            optimizer = agent.model.optimizer
+            optimizer.build(agent.model.trainable_variables)
+            values = _load_arrays(os.path.join(path, 'optimizer.npz'))
+            if len(values) == len(optimizer.variables):
+                for variable, value in zip(optimizer.variables, values):
+                    variable.assign(value)
+            else:
+                print('Optimizer state does not match the model, starting it fresh')
+        if os.path.exists(os.path.join(path, 'replay.npz')):
+            with np.load(os.path.join(path, 'replay.npz')) as replay:
+                agent.memory.load_snapshot(dict(replay))
+        print('\nResumed from ' + name + '\n')
+
+    def close(self):
+        """Wait for the checkpoint being written, then stop the writer"""
+        self.idle.wait()
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+@contextlib.contextmanager
+def _synced(path, mode = 'wb'):
+    """open for writing, flushed and fsynced on the way out so a rename that follows
+    never points at a file the os hasn't written yet"""
+    with open(path, mode) as file:
+        yield file
+        file.flush()
+        os.fsync(file.fileno())
+
+def load_model_weights(path):
+    """The model weights saved in the checkpoint folder path, for set_weights"""
+    return _load_arrays(os.path.join(path, 'model.npz'))
+
+def _load_arrays(path):
+    with np.load(path) as arrays:
+        return [arrays['arr_' + str(i)] for i in range(len(arrays.files))]
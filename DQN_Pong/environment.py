@@ -1,78 +1,152 @@
+import time
 import gym
 import preprocess_frame as ppf
+from frame_stack import FrameStack
 import numpy as np
 
 
-def initialize_new_game(name, env, agent):
+def initialize_new_game(name, env, agent, frame_stack):
     """We don't want an agents past game influencing its new game, \
-        so we add in some dummy data to initialize"""
+        so we fill the frame stack with the starting frame"""
     
     env.reset()
     starting_frame = ppf.resize_frame(env.step(0)[0])
 
-    dummy_action = 0
-    dummy_reward = 0
-    dummy_done = False
-    for i in range(3):
-        agent.memory.add_experience(starting_frame, dummy_reward, dummy_action, dummy_done)
+    starting_action = 0
+    starting_reward = 0
+    starting_done = False
+    agent.memory.add_experience(starting_frame, starting_reward, starting_action, starting_done)
+    frame_stack.reset(starting_frame)
 
 def make_env(name, agent):
     env = gym.make(name, render_mode='rgb_array')
     return env
 
-def take_step(name, env, agent, score, debug, weightsSavePath):
+def take_step(name, env, agent, score, debug, weightsSavePath, frame_stack, checkpoints=None):
     # print("update time steps")
     #1 and 2: Update timesteps and save weights
+    start = agent.timers.now()
     agent.total_timesteps += 1
     if agent.total_timesteps % 50000 == 0:
-      agent.model.save_weights(weightsSavePath)
-      print('\nWeights saved!')
+      if checkpoints is not None:
+        checkpoints.save(agent) # written in the background
+      elif weightsSavePath is not None:
+        agent.model.save_weights(weightsSavePath)
+        print('\nWeights saved!')
+      start = agent.timers.lap('checkpoint', start)
+    if agent.scheduler.epsilon_decay_unit == 'steps':
+      agent.update_epsilon()
     # print("taking action")
     #3: Take action
     next_frame, next_frames_reward, next_frame_terminal, info = env.step(agent.memory.actions[-1])
+    start = agent.timers.lap('env_step', start)
     
     # print("getting next state")
     #4: Get next state
     next_frame = ppf.resize_frame(next_frame)
-    new_state = [agent.memory.frames[-3], agent.memory.frames[-2], agent.memory.frames[-1], next_frame]
-    new_state = np.moveaxis(new_state,0,2)/255 #We have to do this to get it into keras's goofy format of [batch_size,rows,columns,channels]
-    new_state = np.expand_dims(new_state,0) #^^^
+    start = agent.timers.lap('resize_frame', start)
+    new_state = frame_stack.push(next_frame) #already in keras's goofy format of [batch_size,rows,columns,channels]
     
     # print("get next action, use next state")
     #5: Get next action, using next state
     next_action = agent.get_action(new_state)
+    start = agent.timers.lap('act', start)
+    if agent.step_metrics is not None:
+        agent.step_metrics.write({'timestep': agent.total_timesteps, 'reward': next_frames_reward, 'action': next_action, 'epsilon': agent.epsilon})
 
     
     #6: If game is over, return the score
     if next_frame_terminal:
         # print("game over")
         agent.memory.add_experience(next_frame, next_frames_reward, next_action, next_frame_terminal)
+        agent.timers.lap('add_experience', start)
         return (score + next_frames_reward),True
 
     # print("adding experience to memory")
     #7: Now we add the next experience to memory
     agent.memory.add_experience(next_frame, next_frames_reward, next_action, next_frame_terminal)
+    start = agent.timers.lap('add_experience', start)
 
     #8: If we are trying to debug this then render
     if debug:
         # print("rendering to screen")
         env.render()
+        start = agent.timers.lap('render', start)
 
     #9: If the threshold memory is satisfied, make the agent learn from memory
     if len(agent.memory.frames) > agent.starting_mem_len:
         # print("learn from membor")
-        agent.learn(debug)
+        for i in range(agent.scheduler.learn_calls(1)):
+            agent.learn(debug)
+        agent.timers.lap('learn', start)
 
     return (score + next_frames_reward),False
 
-def play_episode(name, env, agent, debug = False, record=False, recordPath="./", weightsSavePath="weights.hd5"):
+def play_episode(name, env, agent, debug = False, record=False, recordPath="./", weightsSavePath="weights.hd5", frame_stack=None, checkpoints=None):
     if record:
         env = gym.wrappers.Monitor(env,recordPath,force=True)
-    initialize_new_game(name, env, agent)
+    if frame_stack is None:
+        frame_stack = FrameStack()
+    initialize_new_game(name, env, agent, frame_stack)
     done = False
     score = 0
     while True:
-        score,done = take_step(name,env,agent,score, debug, weightsSavePath)
+        score,done = take_step(name,env,agent,score, debug, weightsSavePath, frame_stack, checkpoints)
         if done:
             break
     return score
+
+def take_vector_step(env, agent, frame_stack, debug, weightsSavePath, checkpoints=None):
+    """take_step for every env of a VectorEnv at once. Env k's experiences go to memory
+    slots k, k + num_envs, ... (the memory's stride), so its frames never mix with another
+    env's. Returns the envs whose game ended on this step"""
+    #1 and 2: Update timesteps and save weights
+    start = agent.timers.now()
+    previous_timesteps = agent.total_timesteps
+    agent.total_timesteps += env.num_envs
+    if agent.total_timesteps // 50000 != previous_timesteps // 50000:
+      if checkpoints is not None:
+        checkpoints.save(agent) # written in the background
+      else:
+        agent.model.save_weights(weightsSavePath)
+        print('\nWeights saved!')
+      start = agent.timers.lap('checkpoint', start)
+    if agent.scheduler.epsilon_decay_unit == 'steps':
+      agent.update_epsilon()
+
+    #3: Take actions, envs whose game ended last step start a new one instead
+    next_frames, next_rewards, next_dones, new_games = env.step(env.actions)
+    start = agent.timers.lap('env_step', start) # the workers resize their own frames
+
+    #4: Get next states
+    frame_stack.push(next_frames)
+    for i in np.flatnonzero(new_games):
+        frame_stack.reset(next_frames[i], i)
+
+    #5: Get next actions, one forward pass for every env
+    env.actions[:] = agent.get_actions(frame_stack.state)
+    start = agent.timers.lap('act', start)
+    if agent.step_metrics is not None:
+        for i in range(env.num_envs):
+            agent.step_metrics.write({'timestep': previous_timesteps + i + 1, 'reward': next_rewards[i], 'action': env.actions[i], 'epsilon': agent.epsilon})
+
+    #6 and 7: Add every env's experience to memory, in env order
+    for i in range(env.num_envs):
+        agent.memory.add_experience(next_frames[i], next_rewards[i], env.actions[i], next_dones[i])
+    start = agent.timers.lap('add_experience', start)
+
+    #9: If the threshold memory is satisfied, learn as often as the scheduler says for num_envs steps
+    if len(agent.memory.frames) > agent.starting_mem_len:
+        for i in range(agent.scheduler.learn_calls(env.num_envs)):
+            agent.learn(debug)
+        agent.timers.lap('learn', start)
+
+    return np.flatnonzero(next_dones)
+
+def play_vector_episodes(env, agent, frame_stack, debug = False, weightsSavePath="weights.hd5", checkpoints=None):
+    """Step every env until at least one game ends. Returns (score, steps, duration) of each finished game"""
+    while True:
+        finished = take_vector_step(env, agent, frame_stack, debug, weightsSavePath, checkpoints)
+        if len(finished) > 0:
+            now = time.time()
+            return [(env.scores[i], env.episode_steps[i], now - env.episode_start[i]) for i in finished]
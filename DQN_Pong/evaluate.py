@@ -0,0 +1,159 @@
+"""Greedy evaluation of a saved session: plays episodes with a fixed epsilon (0 by
+default) and no learning in a pool of worker processes, and reports the mean and
+variance of the score and the steps per second. With --all-checkpoints every
+checkpoint the session still keeps is evaluated and the best one is named.
+
+    python evaluate.py 1637807740 --episodes 20 --workers 4
+    python evaluate.py 1637807740 --all-checkpoints --epsilon 0.05
+
+--numpy plays with numpy_inference's network instead, so the workers never import
+tensorflow. Results are also written to the session folder as evaluation_<time>.json"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+from loggers import openTrainingConfig
+
+# set in each worker by _start_worker
+worker_agent = None
+worker_env = None
+worker_weights = None # checkpoint the worker's agent holds
+worker_network = None # numpy_inference network, instead of the agent
+worker_settings = None
+
+
+def _start_worker(config, epsilon, modelFilename, fake, use_numpy):
+    """Build one agent (or numpy network) and env per worker process, reused for every
+    episode it plays"""
+    global worker_agent, worker_env, worker_settings
+    import environment
+    from fake_pong import FakePong
+    worker_settings = (config['possible_actions'], epsilon)
+    worker_env = FakePong(os.getpid()) if fake else environment.make_env(config['name'], None)
+    if use_numpy:
+        return
+    import the_agent
+    resume_model = None
+    if modelFilename is not None:
+        from tensorflow.keras.models import load_model
+        resume_model = load_model(modelFilename)
+    # starting_mem_len above max_mem_len: take_step never calls learn
+    worker_agent = the_agent.Agent(config['possible_actions'], 1001, 1000, epsilon, config['learn_rate'], resume_model = resume_model)
+
+def _play(checkpoint, seed):
+    """Play one episode with the weights of checkpoint, returns (score, steps, seconds)"""
+    global worker_weights, worker_network
+    import environment
+    from checkpoints import load_model_weights
+    if worker_agent is None:
+        if checkpoint != worker_weights:
+            import numpy_inference
+            worker_network = numpy_inference.from_weights(load_model_weights(checkpoint))
+            worker_weights = checkpoint
+        return _play_numpy(seed)
+    if checkpoint is not None and checkpoint != worker_weights:
+        worker_agent.model.set_weights(load_model_weights(checkpoint))
+        worker_weights = checkpoint
+    np.random.seed(seed)
+    timesteps = worker_agent.total_timesteps
+    start = time.time()
+    score = environment.play_episode(None, worker_env, worker_agent, weightsSavePath = None)
+    return score, worker_agent.total_timesteps - timesteps, time.time() - start
+
+def _play_numpy(seed):
+    """play_episode's loop with worker_network choosing the actions"""
+    import preprocess_frame as ppf
+    from frame_stack import FrameStack
+    possible_actions, epsilon = worker_settings
+    rng = np.random.default_rng(seed)
+    start = time.time()
+    worker_env.reset()
+    frame_stack = FrameStack()
+    frame_stack.reset(ppf.resize_frame(worker_env.step(0)[0]))
+    action = 0
+    score = 0
+    steps = 0
+    done = False
+    while not done:
+        frame, reward, done, info = worker_env.step(action)
+        state = frame_stack.push(ppf.resize_frame(frame))
+        if rng.random() < epsilon:
+            action = possible_actions[rng.integers(len(possible_actions))]
+        else:
+            action = possible_actions[int(np.argmax(worker_network(state)))]
+        score += reward
+        steps += 1
+    return score, steps, time.time() - start
+
+def evaluate(pool, checkpoint, episodes, workers):
+    start = time.time()
+    results = pool.starmap(_play, [(checkpoint, seed) for seed in range(episodes)])
+    wall = time.time() - start
+    scores = np.array([result[0] for result in results])
+    steps = np.array([result[1] for result in results])
+    seconds = np.array([result[2] for result in results])
+    return {
+        'checkpoint': None if checkpoint is None else os.path.basename(checkpoint)
+    ,   'episodes': episodes
+    ,   'mean_score': float(scores.mean())
+    ,   'score_variance': float(scores.var())
+    ,   'min_score': float(scores.min())
+    ,   'max_score': float(scores.max())
+    ,   'mean_steps': float(steps.mean())
+    ,   'steps_per_sec_per_worker': float(steps.sum() / seconds.sum())
+    ,   'steps_per_sec': float(steps.sum() / wall)
+    ,   'workers': workers
+    }
+
+def main(sessionId, episodes = 10, workers = None, epsilon = 0, all_checkpoints = False, fake = False, use_numpy = False):
+    sessionFolderpath = "./session_"+sessionId+"/"
+    if not os.path.exists(sessionFolderpath):
+        print("Error: cannot find session folder for session id: "+sessionId)
+        return
+    config = openTrainingConfig(sessionFolderpath+"config_"+sessionId+".json")
+    checkpointsFolderpath = sessionFolderpath+"checkpoints/"
+
+    modelFilename = None
+    if 'checkpoint' not in config: # sessions from before checkpoints only have the keras model
+        if use_numpy:
+            print("Error: --numpy needs a session with checkpoints")
+            return
+        modelFilename = sessionFolderpath+"model_"+sessionId
+        checkpoints = [None]
+    elif all_checkpoints:
+        checkpoints = [checkpointsFolderpath + name for name in sorted(os.listdir(checkpointsFolderpath))\
+                        if name.startswith('ckpt_') and not name.endswith('.tmp')]
+    else:
+        checkpoints = [checkpointsFolderpath + config['checkpoint']]
+
+    workers = workers or os.cpu_count()
+    # spawn, tensorflow isn't safe to fork
+    with mp.get_context('spawn').Pool(workers, _start_worker, (config, epsilon, modelFilename, fake, use_numpy)) as pool:
+        evaluations = []
+        for checkpoint in checkpoints:
+            evaluation = evaluate(pool, checkpoint, episodes, workers)
+            evaluation['epsilon'] = epsilon
+            evaluation['numpy'] = use_numpy
+            print(evaluation)
+            evaluations.append(evaluation)
+
+    best = max(evaluations, key = lambda evaluation: evaluation['mean_score'])
+    if len(evaluations) > 1:
+        print('Best checkpoint: %s, mean score %.2f' % (best['checkpoint'], best['mean_score']))
+    with open(sessionFolderpath+"evaluation_"+str(int(time.time()))+".json", 'w') as file:
+        json.dump({'sessionId': sessionId, 'evaluations': evaluations, 'best': best['checkpoint']}, file, indent = 2)
+    return evaluations
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Greedy evaluation of a saved DQN session')
+    parser.add_argument('sessionId')
+    parser.add_argument('--episodes', type = int, default = 10, help = 'episodes per checkpoint')
+    parser.add_argument('--workers', type = int, help = 'worker processes, one per cpu by default')
+    parser.add_argument('--epsilon', type = float, default = 0, help = 'chance of a random action')
+    parser.add_argument('--all-checkpoints', action = 'store_true', help = 'evaluate every checkpoint the session keeps')
+    parser.add_argument('--fake', action = 'store_true', help = 'play FakePong, for checking the setup without Atari ROMs')
+    parser.add_argument('--numpy', action = 'store_true', help = 'act with numpy_inference, without tensorflow')
+    args = parser.parse_args()
+    main(args.sessionId, args.episodes, args.workers, args.epsilon, args.all_checkpoints, args.fake, args.numpy)
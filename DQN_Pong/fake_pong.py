@@ -0,0 +1,57 @@
+import numpy as np
+
+BACKGROUND = (144, 72, 17)
+LEFT_PADDLE = (213, 130, 74)
+RIGHT_PADDLE = (92, 186, 92)
+BALL = (236, 236, 236)
+
+
+class FakePong():
+    """Deterministic stand-in for gym's Pong with the same old gym interface and
+    210x160x3 uint8 frames in Pong's colours, so the preprocessing and both agents
+    can be run and timed without Atari ROMs. The ball bounces around the court,
+    the paddles follow it, a point is scored every point_steps steps and a game
+    ends after points_per_game points"""
+    def __init__(self, seed = 0, point_steps = 60, points_per_game = 21):
+        self.rng = np.random.default_rng(seed)
+        self.point_steps = point_steps
+        self.points_per_game = points_per_game
+        self.frame = np.empty((210,160,3),dtype = np.uint8)
+        self.reset()
+
+    def reset(self):
+        self.t = 0
+        self.points = 0
+        self.ball = np.array([110., 80.])
+        self.velocity = self.rng.choice([-1.,1.],size = 2) * [2., 3.]
+        return self._render()
+
+    def _render(self):
+        frame = self.frame
+        frame[:] = BACKGROUND
+        frame[24:34] = (236,236,236) # score bar, cropped away by both preprocessings
+        frame[194:] = (236,236,236)
+        y = int(self.ball[0])
+        frame[y - 15:y + 1,16:20] = LEFT_PADDLE
+        frame[y - 15:y + 1,140:144] = RIGHT_PADDLE
+        frame[y:y + 4,int(self.ball[1]):int(self.ball[1]) + 2] = BALL
+        return frame.copy()
+
+    def step(self, action):
+        self.t += 1
+        self.ball += self.velocity
+        for axis, low, high in ((0, 35, 189), (1, 20, 138)):
+            if not low <= self.ball[axis] <= high:
+                self.velocity[axis] = -self.velocity[axis]
+                self.ball[axis] = np.clip(self.ball[axis], low, high)
+        reward = 0.
+        if self.t % self.point_steps == 0:
+            reward = float(self.rng.choice([-1.,1.]))
+            self.points += 1
+        return self._render(), reward, self.points >= self.points_per_game, {}
+
+    def render(self, mode = 'human'):
+        return self.frame
+
+    def close(self):
+        pass
@@ -0,0 +1,22 @@
+import numpy as np
+
+class FrameStack():
+    """The last 4 preprocessed frames, kept in keras's [batch_size,rows,columns,channels]
+    layout and updated in place so the actor doesn't build a new state every step.
+    With num_stacks > 1 there is one stack per environment along the batch axis"""
+    def __init__(self,num_frames = 4,num_stacks = 1):
+        self.state = np.zeros((num_stacks,84,84,num_frames),dtype = np.uint8)
+
+    def reset(self,frame,index = None):
+        """Fill every channel with the first frame of a new game, for one stack or all of them"""
+        if index is None:
+            self.state[:] = frame[...,None]
+        else:
+            self.state[index] = frame[...,None]
+
+    def push(self,frame):
+        """Drop the oldest frame and write the newest one (one per stack) into the last channel"""
+        for i in range(self.state.shape[-1] - 1):
+            np.copyto(self.state[...,i],self.state[...,i+1])
+        self.state[...,-1] = frame
+        return self.state
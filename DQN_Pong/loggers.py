@@ -1,6 +1,8 @@
 import json
 import csv
 import os
+import time
+import numpy as np
 from json import JSONEncoder
 
 class NumpyArrayEncoder(JSONEncoder):
@@ -59,21 +61,109 @@ def openTrainingConfig(filename):
     jsonFile.close()
     return config
 
-def saveDictionaryToCSV(dictData,filenameAndPath):
-    headers = dictData.keys()
-    values = dictData.values()
-    firstRun = False
-    try:
-        if (not os.path.exists(filenameAndPath)):
-            firstRun = True
-        file = open(filenameAndPath, 'a')
-        writer = csv.writer(file)
-        if (firstRun):
-            writer.writerow(headers)
-        writer.writerow(values)
-        file.close()
-    except IOError:
-        print("I/O error")
+class MetricsWriter():
+    """Keeps metric rows in memory as typed columns and writes them out in batches,
+    every maxRows rows or maxSeconds seconds and on close. format 'csv' appends them
+    to a csv file with a header row, 'binary' appends each column to its own raw
+    file in a folder, which readMetrics loads back with a single read per column.
+    The columns are the first row's keys. Use it in a with block or call close, so
+    the rows held still get written when training is interrupted"""
+    def __init__(self, filenameAndPath, maxRows=100, maxSeconds=30, format='csv'):
+        if format not in ('csv', 'binary'):
+            raise ValueError('format must be csv or binary')
+        self.filenameAndPath = filenameAndPath
+        self.maxRows = maxRows
+        self.maxSeconds = maxSeconds
+        self.format = format
+        self.columns = None # column name -> values not written yet
+        self.dtypes = None
+        self.rows = 0
+        self.lastFlush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def _start(self, row):
+        self.columns = {name: [] for name in row}
+        self.dtypes = {name: np.asarray(value).dtype for name, value in row.items()}
+        if self.format == 'binary':
+            for name, dtype in self.dtypes.items():
+                if dtype.kind not in 'biuf':
+                    raise ValueError('binary metrics must be numbers, '+name+' is '+str(dtype))
+            schemaFilename = os.path.join(self.filenameAndPath, 'columns.json')
+            if os.path.exists(schemaFilename): # a resumed session appends to the same columns
+                with open(schemaFilename, 'r') as file:
+                    schema = json.load(file)
+                if list(schema) != list(self.columns):
+                    raise ValueError(schemaFilename+' has columns '+str(list(schema)))
+                self.dtypes = {name: np.dtype(dtype) for name, dtype in schema.items()}
+            else:
+                os.makedirs(self.filenameAndPath, exist_ok=True)
+                with open(schemaFilename, 'w') as file:
+                    json.dump({name: dtype.str for name, dtype in self.dtypes.items()}, file)
+        else:
+            self.filenameAndPath = self._csvFor([str(name) for name in self.columns])
+
+    def _csvFor(self, header):
+        """The csv file to append rows with these columns to: the one asked for unless it has
+        another header row, as when resuming an older session or switching between sync
+        and async training. Then the first of name_2.csv, name_3.csv.. that is new or matches"""
+        stem, extension = os.path.splitext(self.filenameAndPath)
+        filename, number = self.filenameAndPath, 1
+        while os.path.exists(filename):
+            with open(filename, 'r', newline='') as file:
+                if next(csv.reader(file), None) in (header, None):
+                    break
+            number += 1
+            filename = stem+'_'+str(number)+extension
+        if filename != self.filenameAndPath:
+            print(self.filenameAndPath+' has other columns, appending to '+filename)
+        return filename
+
+    def write(self, row):
+        if self.columns is None:
+            self._start(row)
+        for name, values in self.columns.items():
+            values.append(row[name])
+        self.rows += 1
+        if self.rows >= self.maxRows or time.time() - self.lastFlush >= self.maxSeconds:
+            self.flush()
+
+    def flush(self):
+        self.lastFlush = time.time()
+        if self.rows == 0:
+            return
+        if self.format == 'csv':
+            firstRun = not os.path.exists(self.filenameAndPath) or os.path.getsize(self.filenameAndPath) == 0
+            with open(self.filenameAndPath, 'a', newline='') as file:
+                writer = csv.writer(file)
+                if firstRun:
+                    writer.writerow(self.columns.keys())
+                writer.writerows(zip(*self.columns.values()))
+        else:
+            for name, values in self.columns.items():
+                with open(os.path.join(self.filenameAndPath, name+'.bin'), 'ab') as file:
+                    np.asarray(values, dtype=self.dtypes[name]).tofile(file)
+        for values in self.columns.values():
+            values.clear()
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+
+def readMetrics(filenameAndPath):
+    """Load what a MetricsWriter wrote, as a dictionary of column name -> numpy array"""
+    if os.path.isdir(filenameAndPath):
+        with open(os.path.join(filenameAndPath, 'columns.json'), 'r') as file:
+            schema = json.load(file)
+        columns = {name: np.fromfile(os.path.join(filenameAndPath, name+'.bin'), dtype=dtype) for name, dtype in schema.items()}
+        rows = min(len(values) for values in columns.values()) # in case a flush was cut short
+        return {name: values[:rows] for name, values in columns.items()}
+    table = np.genfromtxt(filenameAndPath, delimiter=',', names=True, dtype=None, encoding=None)
+    return {name: table[name] for name in table.dtype.names}
 
 def saveModelJsonSummary(modelJSON, summaryFilenameAndPath):
     with open(summaryFilenameAndPath, "w") as json_file:
@@ -1,12 +1,20 @@
 import the_agent
 import environment
+from frame_stack import FrameStack
+from agent_memory import make_memory
+from vector_environment import VectorEnv
+from agent_memory import SharedReplayMemory, ShardedMemory
+from scheduler import Scheduler
+from phase_timers import PhaseTimers, SamplingProfiler
+from checkpoints import CheckpointManager, load_model_weights
+import async_training
+import multiprocessing as mp
 import matplotlib.pyplot as plt
 import time
 from collections import deque
 import numpy as np
-from loggers import saveDictionaryToCSV\
+from loggers import MetricsWriter\
                     , openTrainingConfig\
-                    , saveTrainingConfig\
                     , saveModelJsonSummary
 from datetime import datetime
 from tensorflow.keras.models import load_model
@@ -34,6 +42,7 @@ def train(silent=False,sessionId=None):
     sessionFolderpath = "./session_"+sessionId+"/"
     configFilename = sessionFolderpath+"config_"+sessionId+".json"
     historyFilename = sessionFolderpath+"history_"+sessionId+".csv"
+    stepsFolderpath = sessionFolderpath+"steps_"+sessionId+"/"
     modelFilename = sessionFolderpath+"model_"+sessionId
     weightsFilename = sessionFolderpath+"weights_"+sessionId+".hd5"
     modelSummaryFilename = sessionFolderpath+"model_"+sessionId+".json"
@@ -42,14 +51,44 @@ def train(silent=False,sessionId=None):
     saved_model = None
     if(isResumingSession):    
         config = openTrainingConfig(configFilename)
-        saved_model = load_model(modelFilename)
+        if 'checkpoint' not in config: # sessions from before checkpoints
+            saved_model = load_model(modelFilename)
     else:
         config = {
             'name': 'PongDeterministic-v4'
         ,   'possible_actions': [0,2,3]
         ,   'starting_mem_len': 50000
         ,   'max_mem_len': 750000
+        ,   'replay_backend': 'ram' # 'memmap' keeps the replay memory in the session folder across resumes, 'compressed' zlibs every frame
+        ,   'prioritized_replay': False
+        ,   'priority_alpha': 0.6
+        ,   'priority_beta': 0.4
+        ,   'num_envs': 1 # more than 1 steps that many envs in parallel worker processes
+        ,   'num_actors': 0 # more than 0 plays in actor processes while a learner process trains
+        ,   'actor_sync_steps': 400
+        ,   'weights_publish_interval': 100
+        ,   'model_save_interval': 5000
         ,   'starting_epsilon': 1
+        ,   'epsilon_min': 0.05
+        ,   'epsilon_decay': 0.9/100000
+        ,   'epsilon_decay_unit': 'learns' # or 'steps'
+        ,   'updates_per_step': 1 # 0.25 learns once every 4 env steps
+        ,   'fused_updates': 1 # gradient updates per compiled call
+        ,   'target_sync_interval': 10000
+        ,   'prefetch_batches': 0 # above 0, the next learn's minibatches are gathered on a background thread
+        ,   'replay_seed': None # seeds the replay sampling, the same batches with or without prefetch_batches
+        ,   'phase_timers': True # per phase times in the history, see phase_timers
+        ,   'profile_episodes': None # [first, last] to write a sampling profile of those episodes
+        ,   'checkpoint_keep': 3 # newest checkpoints kept in the session's checkpoints folder
+        ,   'checkpoint_every_episodes': 1
+        ,   'checkpoint_every_seconds': 0 # 0 checkpoints on the episode cadence only
+        ,   'checkpoint_optimizer': True
+        ,   'checkpoint_replay': False # the ram backend's snapshot is a full copy of the replay memory
+        ,   'history_flush_rows': 20 # history rows held in memory before they are written
+        ,   'history_flush_seconds': 60
+        ,   'step_metrics': False # per step reward, action and epsilon in the binary steps_<id> folder, see loggers.readMetrics
+        ,   'learns': 0
+        ,   'total_timesteps': 0
         ,   'learn_rate': 0.00025
         ,   'episode_number': 0
         ,   'debug': True # set true to see game monitor
@@ -58,6 +97,66 @@ def train(silent=False,sessionId=None):
         }
     
     config['debug'] = not silent # use the setting supplied when calling the function.
+    config.setdefault('replay_backend','ram') # sessions from before the settings existed
+    config.setdefault('prioritized_replay',False)
+    config.setdefault('priority_alpha',0.6)
+    config.setdefault('priority_beta',0.4)
+    config.setdefault('num_envs',1)
+    config.setdefault('num_actors',0)
+    config.setdefault('actor_sync_steps',400)
+    config.setdefault('weights_publish_interval',100)
+    config.setdefault('model_save_interval',5000)
+    config.setdefault('epsilon_min',0.05)
+    config.setdefault('epsilon_decay',0.9/100000)
+    config.setdefault('epsilon_decay_unit','learns')
+    config.setdefault('updates_per_step',1)
+    config.setdefault('fused_updates',1)
+    config.setdefault('target_sync_interval',10000)
+    config.setdefault('prefetch_batches',0)
+    config.setdefault('replay_seed',None)
+    config.setdefault('phase_timers',True)
+    config.setdefault('profile_episodes',None)
+    config.setdefault('checkpoint_keep',3)
+    config.setdefault('checkpoint_every_episodes',1)
+    config.setdefault('checkpoint_every_seconds',0)
+    config.setdefault('checkpoint_optimizer',True)
+    config.setdefault('checkpoint_replay',False)
+    config.setdefault('history_flush_rows',20)
+    config.setdefault('history_flush_seconds',60)
+    config.setdefault('step_metrics',False)
+    config.setdefault('learns',0)
+    config.setdefault('total_timesteps',0)
+
+    if config['num_actors'] > 0:
+        # one shared-memory replay shard per actor, prioritized replay and the
+        # memmap and compressed backends only apply to the synchronous trainer
+        context = mp.get_context('spawn')
+        shards = [SharedReplayMemory(config['max_mem_len'] // config['num_actors'],lock=context.Lock())\
+                    for actor in range(config['num_actors'])]
+        agent = the_agent.Agent(config['possible_actions']\
+                                ,config['starting_mem_len']\
+                                ,config['max_mem_len']\
+                                ,config['starting_epsilon']\
+                                ,config['learn_rate']\
+                                ,resume_model=saved_model
+                                ,memory=ShardedMemory(shards))
+        if 'checkpoint' in config: # last written by the synchronous trainer, see async_training.train
+            agent.model.set_weights(load_model_weights(sessionFolderpath+"checkpoints/"+config['checkpoint']))
+        if(not isResumingSession):
+            saveModelJsonSummary(agent.model.to_json(),modelSummaryFilename)
+        async_training.train(config, agent, sessionId, configFilename, historyFilename, modelFilename)
+        return
+
+    # forked before the agent exists, see VectorEnv
+    env = None
+    if config['num_envs'] > 1:
+        env = VectorEnv(config['name'],config['num_envs'])
+
+    memory = make_memory(config['replay_backend'],config['max_mem_len'],sessionFolderpath,stride=config['num_envs'],seed=config['replay_seed'])
+    if 'replay_count' in config and len(memory) == 0: # memmap sessions from before replay_cursor.npy
+        memory.restore(config['replay_index'],config['replay_count'])
+    if config['prioritized_replay']:
+        memory.use_priorities(config['priority_alpha'])
 
     agent = the_agent.Agent(config['possible_actions']\
                             ,config['starting_mem_len']\
@@ -65,9 +164,29 @@ def train(silent=False,sessionId=None):
                             ,config['starting_epsilon']\
                             ,config['learn_rate']\
                             ,debug=config['debug']
-                            ,resume_model=saved_model)
+                            ,resume_model=saved_model
+                            ,memory=memory
+                            ,priority_beta=config['priority_beta']
+                            ,scheduler=Scheduler.from_config(config)
+                            ,prefetch=config['prefetch_batches'] > 0
+                            ,timers=PhaseTimers(config['phase_timers']))
+    agent.learns = int(config['learns']) # pick the schedule up where the session left it
+    agent.total_timesteps = int(config['total_timesteps'])
+    agent.update_epsilon()
+
+    checkpoints = CheckpointManager(sessionFolderpath+"checkpoints/"\
+                                    ,config\
+                                    ,configFilename\
+                                    ,keep=config['checkpoint_keep']\
+                                    ,every_episodes=config['checkpoint_every_episodes']\
+                                    ,every_seconds=config['checkpoint_every_seconds']\
+                                    ,include_optimizer=config['checkpoint_optimizer']\
+                                    ,include_replay=config['checkpoint_replay'])
+    if 'checkpoint' in config:
+        checkpoints.restore(agent,config['checkpoint'])
     
-    env = environment.make_env(config['name'],agent)
+    if env is None:
+        env = environment.make_env(config['name'],agent)
 
     # if first run of this model/session
     # then dump model summary and 
@@ -78,45 +197,96 @@ def train(silent=False,sessionId=None):
     scores = deque(maxlen = 100)
     max_score = -21
 
-    env.reset()
+    frame_stack = FrameStack(num_stacks=config['num_envs']) # reused by every episode
+    if config['num_envs'] == 1:
+        env.reset()
     i = int(config['episode_number'])
     recordEpisode = False
-    while True:
-        timesteps = agent.total_timesteps
-        time_elapsed = time.time()
-        score = environment.play_episode(config['name']\
-                                        , env\
-                                        , agent\
-                                        , config['debug']\
-                                        , record=recordEpisode\
-                                        , recordPath=videoFolderPath+"/ep_"+str(i)\
-                                        , weightsSavePath=weightsFilename\
-                                        ) #set debug to true for rendering
-        recordEpisode = False # reset record flag
-        scores.append(score)
-        if score > max_score:
-            max_score = score
-
-        episodeData = {
-            'sessionId': sessionId
-        ,   'episode_number': str(i)
-        ,   'steps': str(agent.total_timesteps - timesteps)
-        ,   'duration': str(time.time() - time_elapsed)
-        ,   'score': str(score)
-        ,   'max_score': str(max_score)
-        ,   'epsilon': str(agent.epsilon)
-        }
-        print(episodeData)
+    profiler = SamplingProfiler()
+    history = MetricsWriter(historyFilename,config['history_flush_rows'],config['history_flush_seconds'])
+    if config['step_metrics']:
+        agent.step_metrics = MetricsWriter(stepsFolderpath,10000,config['history_flush_seconds'],format='binary')
+    try:
+        while True:
+            if config['profile_episodes'] != None and profiler.thread == None\
+                    and config['profile_episodes'][0] <= i <= config['profile_episodes'][1]:
+                profiler.start()
+            timesteps = agent.total_timesteps
+            time_elapsed = time.time()
+            if config['num_envs'] == 1:
+                score = environment.play_episode(config['name']\
+                                                , env\
+                                                , agent\
+                                                , config['debug']\
+                                                , record=recordEpisode\
+                                                , recordPath=videoFolderPath+"/ep_"+str(i)\
+                                                , weightsSavePath=weightsFilename\
+                                                , frame_stack=frame_stack\
+                                                , checkpoints=checkpoints\
+                                                ) #set debug to true for rendering
+                recordEpisode = False # reset record flag
+                finished = [(score, agent.total_timesteps - timesteps, time.time() - time_elapsed)]
+            else:
+                finished = environment.play_vector_episodes(env\
+                                                            , agent\
+                                                            , frame_stack\
+                                                            , config['debug']\
+                                                            , weightsSavePath=weightsFilename\
+                                                            , checkpoints=checkpoints\
+                                                            )
+            # each game reports its own duration, this is the wall time of the whole batch
+            env_steps_per_sec = (agent.total_timesteps - timesteps) / (time.time() - time_elapsed)
+            timers = agent.timers
+            action_latency = timers.mean_ms('greedy_action')
+            sample_ms, train_ms = timers.mean_ms('sample'), timers.mean_ms('train')
+            phases = timers.summary()
+
+            for score, steps, duration in finished:
+                scores.append(score)
+                if score > max_score:
+                    max_score = score
+
+                episodeData = {
+                    'sessionId': sessionId
+                ,   'episode_number': i
+                ,   'steps': steps
+                ,   'duration': duration
+                ,   'score': score
+                ,   'max_score': max_score
+                ,   'epsilon': agent.epsilon
+                ,   'action_latency_ms': action_latency
+                ,   'num_envs': config['num_envs']
+                ,   'env_steps_per_sec': env_steps_per_sec
+                ,   'sample_ms_per_learn': sample_ms
+                ,   'train_ms_per_learn': train_ms
+                }
+                if config['replay_backend'] == 'compressed':
+                    episodeData['compression_ratio'] = agent.memory.compression_ratio()
+                    episodeData['decode_ms_per_batch'] = agent.memory.decode_latency()
+                episodeData.update(phases) # shared by every episode that ended in this batch
+                print(episodeData)
+
+                start = timers.now()
+                history.write(episodeData) # save history
+                timers.lap('history_save',start)
+                config['episode_number'] = str(i)
 
-        saveDictionaryToCSV(episodeData,historyFilename) # save history
-        agent.model.save(modelFilename) # save model
+                if i%100==0:
+                    recordEpisode = True
+                i += 1
 
-        config['episode_number'] = str(i)
-        saveTrainingConfig(config,configFilename) # saveConfig
+            if profiler.thread != None and i > config['profile_episodes'][1]:
+                profiler.stop(sessionFolderpath+"profile_"+sessionId+"_"+str(config['profile_episodes'][0])+"-"+str(config['profile_episodes'][1])+".folded")
 
-        if i%100==0:
-            recordEpisode = True
-        i += 1
+            start = timers.now()
+            if checkpoints.due(int(config['episode_number'])):
+                checkpoints.save(agent) # the model, and the config pointing at it, are written in the background
+            timers.lap('checkpoint',start)
+    finally:
+        history.close() # write the rows still held, also when interrupted
+        if agent.step_metrics is not None:
+            agent.step_metrics.close()
+        checkpoints.close() # let a checkpoint being written finish
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,175 @@
+"""The Agent's Q network (see Agent._build_model) run with numpy alone, so evaluation
+workers and other tools that only act don't have to import tensorflow.
+
+export writes a model's weights to a flat binary file: an 8 byte magic, the length
+of a json header describing each layer, the header, then every array at a 64 byte
+aligned offset. Kernels are stored already laid out for the im2col matrix product,
+with the input's 1/255 rescaling folded into the first one, so loading is just
+mapping the file. With int8 the kernels are quantized per output channel (a float32
+scale each), which makes the file 4 times smaller. numpy has no fast int8 matrix
+product, so they are turned back into float32 when the file is loaded.
+
+    python numpy_inference.py export session_1/checkpoints/ckpt_000000050000 q.bin --int8
+    python numpy_inference.py compare session_1/checkpoints/ckpt_000000050000"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+MAGIC = b'DQNNPY1\0'
+# (kernel size, stride) of the three conv layers, then two dense layers
+CONVOLUTIONS = ((8, 4), (4, 2), (3, 1))
+
+
+def _prepare(weights):
+    """(kernel, bias) of each layer from the list model.get_weights() gives, kernels
+    laid out for the matrix product"""
+    prepared = []
+    for i in range(0, len(weights), 2):
+        kernel, bias = np.asarray(weights[i], dtype = np.float32), np.asarray(weights[i + 1], dtype = np.float32)
+        if kernel.ndim == 4: # keras (height, width, channels, filters) -> im2col (channels * height * width, filters)
+            kernel = kernel.transpose(2, 0, 1, 3).reshape(-1, kernel.shape[3])
+        if i == 0:
+            kernel = kernel / 255 # the Rescaling layer
+        prepared.append((np.ascontiguousarray(kernel), bias))
+    return prepared
+
+def export(weights, path, int8 = False):
+    """Write the list model.get_weights() (or checkpoints.load_model_weights) gives to path"""
+    arrays = []
+    layers = []
+    for kernel, bias in _prepare(weights):
+        layer = {'shape': list(kernel.shape), 'kernel': len(arrays), 'bias': len(arrays) + 1}
+        if int8:
+            scale = np.maximum(np.abs(kernel).max(axis = 0), 1e-12) / 127
+            arrays += [np.round(kernel / scale).astype(np.int8), bias, scale.astype(np.float32)]
+            layer['scale'] = len(arrays) - 1
+        else:
+            arrays += [kernel, bias]
+        layers.append(layer)
+
+    offsets = []
+    offset = 0
+    for array in arrays:
+        offsets.append(offset)
+        offset += -(-array.nbytes // 64) * 64
+    header = json.dumps({'layers': layers\
+                        , 'arrays': [{'offset': o, 'dtype': a.dtype.str, 'shape': list(a.shape)} for o, a in zip(offsets, arrays)]}).encode()
+    start = -(-(len(MAGIC) + 8 + len(header)) // 64) * 64
+    with open(path, 'wb') as file:
+        file.write(MAGIC + np.uint64(len(header)).tobytes() + header)
+        for o, array in zip(offsets, arrays):
+            file.seek(start + o)
+            file.write(array.tobytes())
+
+class NumpyQNetwork():
+    """Q values for batches of uint8 (N,84,84,4) states, see load and from_weights"""
+    def __init__(self, kernels, biases):
+        self.kernels = kernels
+        self.biases = biases
+
+    def __call__(self, states):
+        x = np.asarray(states)
+        for (size, stride), kernel, bias in zip(CONVOLUTIONS, self.kernels, self.biases):
+            # im2col: every size x size window becomes a row, ordered (channels, height, width)
+            patches = sliding_window_view(x, (size, size), axis = (1, 2))[:, ::stride, ::stride]
+            n, height, width = patches.shape[:3]
+            x = patches.reshape(n * height * width, -1).astype(np.float32, copy = False) @ kernel
+            x += bias
+            np.maximum(x, 0, out = x)
+            x = x.reshape(n, height, width, -1)
+        x = x.reshape(len(x), -1) # channels last, like Flatten
+        x = x @ self.kernels[3] + self.biases[3]
+        np.maximum(x, 0, out = x)
+        return x @ self.kernels[4] + self.biases[4]
+
+def from_weights(weights):
+    """NumpyQNetwork straight from the list model.get_weights() gives"""
+    kernels, biases = zip(*_prepare(weights))
+    return NumpyQNetwork(list(kernels), list(biases))
+
+def load(path):
+    """NumpyQNetwork from a file export wrote, mapped rather than read when not int8"""
+    data = np.memmap(path, dtype = np.uint8, mode = 'r')
+    if bytes(data[:8]) != MAGIC:
+        raise ValueError(path + ' is not a numpy_inference export')
+    length = int(data[8:16].view(np.uint64)[0])
+    header = json.loads(bytes(data[16:16 + length]))
+    start = -(-(16 + length) // 64) * 64
+    arrays = []
+    for array in header['arrays']:
+        dtype = np.dtype(array['dtype'])
+        size = int(np.prod(array['shape'])) * dtype.itemsize
+        arrays.append(data[start + array['offset']:start + array['offset'] + size].view(dtype).reshape(array['shape']))
+    kernels = []
+    biases = []
+    for layer in header['layers']:
+        kernel = arrays[layer['kernel']]
+        if 'scale' in layer:
+            kernel = kernel.astype(np.float32) * arrays[layer['scale']]
+        kernels.append(kernel)
+        biases.append(arrays[layer['bias']])
+    return NumpyQNetwork(kernels, biases)
+
+def _fake_states(count):
+    """States from FakePong frames, for comparing the two networks"""
+    import preprocess_frame as ppf
+    from fake_pong import FakePong
+    env = FakePong(0)
+    frames = ppf.resize_frames(np.stack([env.step(0)[0] for i in range(count + 3)]))
+    return np.stack([frames[i:i + 4].transpose(1, 2, 0) for i in range(count)])
+
+def compare(checkpoint):
+    """Startup time, memory and per step latency of this network against the keras one,
+    and how far apart their Q values are"""
+    from checkpoints import load_model_weights
+    weights = load_model_weights(checkpoint)
+    folder = tempfile.mkdtemp()
+    for int8 in (False, True):
+        export(weights, os.path.join(folder, 'int8.bin' if int8 else 'float32.bin'), int8)
+    print('export: float32 %.1f MB, int8 %.1f MB' % (os.path.getsize(os.path.join(folder, 'float32.bin')) / 1e6\
+                                                    , os.path.getsize(os.path.join(folder, 'int8.bin')) / 1e6))
+
+    # a fresh process each: import, load the weights and pick one action
+    here = os.path.dirname(os.path.abspath(__file__))
+    startups = {
+        'numpy': 'import numpy as np, numpy_inference; q = numpy_inference.load(%r); q(np.zeros((1,84,84,4),np.uint8))' % os.path.join(folder, 'float32.bin')
+    ,   'keras': 'import numpy as np, the_agent, checkpoints; a = the_agent.Agent([0,2,3],1,1,0,.00025); a.model.set_weights(checkpoints.load_model_weights(%r)); a._predict(np.zeros((1,84,84,4),np.uint8))' % checkpoint
+    }
+    for name, code in startups.items():
+        start = time.time()
+        output = subprocess.run([sys.executable, '-c', code + '; import resource; print("maxrss", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)']\
+                                , cwd = here, capture_output = True, text = True).stdout
+        rss = [line for line in output.splitlines() if line.startswith('maxrss')][0].split()[1]
+        print('%s startup: %.2f s, %.0f MB peak rss' % (name, time.time() - start, int(rss) / 1024))
+
+    states = _fake_states(64)
+    networks = {'numpy float32': load(os.path.join(folder, 'float32.bin')), 'numpy int8': load(os.path.join(folder, 'int8.bin'))}
+    import tensorflow as tf
+    import the_agent
+    agent = the_agent.Agent([0,2,3], 1, 1, 0, .00025)
+    agent.model.set_weights(weights)
+    networks['keras'] = lambda states: agent._predict(tf.constant(states, dtype = tf.uint8)).numpy()
+    expected = networks['keras'](states)
+    for name, network in networks.items():
+        network(states[:1])
+        start = time.perf_counter()
+        for state in states:
+            network(state[None])
+        latency = (time.perf_counter() - start) / len(states) * 1000
+        q_values = network(states)
+        print('%-14s %.2f ms per step, max |Q - keras Q| %.2e, same action %d%%' % (name, latency\
+                , np.abs(q_values - expected).max(), 100 * np.mean(q_values.argmax(1) == expected.argmax(1))))
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'export':
+        from checkpoints import load_model_weights
+        export(load_model_weights(sys.argv[2]), sys.argv[3], '--int8' in sys.argv)
+    elif len(sys.argv) == 3 and sys.argv[1] == 'compare':
+        compare(sys.argv[2])
+    else:
+        print(__doc__)
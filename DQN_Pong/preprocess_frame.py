@@ -15,9 +15,32 @@ import cv2
 import numpy as np
 
 
-def resize_frame(frame):
+def resize_frame_cv2(frame):
+    """The original preprocessing, kept as the reference resize_frame must match"""
     frame = frame[30:-12,5:-4]
     frame = np.average(frame,axis = 2)
     frame = cv2.resize(frame,(84,84),interpolation = cv2.INTER_NEAREST)
     frame = np.array(frame,dtype = np.uint8)
-    return frame
\ No newline at end of file
+    return frame
+
+# The raw frame rows and columns cv2's nearest resize of the 168x151 crop picks,
+# asked from cv2 itself so they match it exactly
+_rows = 30 + cv2.resize(np.arange(168,dtype = np.float32)[:,None].repeat(151,axis = 1),(84,84),interpolation = cv2.INTER_NEAREST)[:,0].astype(np.intp)
+_columns = 5 + cv2.resize(np.arange(151,dtype = np.float32)[None,:].repeat(168,axis = 0),(84,84),interpolation = cv2.INTER_NEAREST)[0].astype(np.intp)
+
+def resize_frame(frame,out = None):
+    """Crop, grayscale and resize in one pass: only the 84x84 pixels the resize keeps are
+    read, and their RGB mean is taken in integers. (r+g+b)//3 is exactly what the float
+    average truncated to uint8 gave, so the output is pixel for pixel resize_frame_cv2's.
+    Pass out to reuse an 84x84 uint8 buffer"""
+    return resize_frames(frame[None],None if out is None else out[None])[0]
+
+def resize_frames(frames,out = None):
+    """resize_frame for a batch of raw frames (N,210,160,3), gives (N,84,84)"""
+    pixels = frames.take(_rows,axis = 1).take(_columns,axis = 2)
+    total = np.add(pixels[...,0],pixels[...,1],dtype = np.uint16)
+    total += pixels[...,2]
+    if out is None:
+        out = np.empty(total.shape,dtype = np.uint8)
+    np.floor_divide(total,3,out = out,casting = 'unsafe')
+    return out
\ No newline at end of file
@@ -0,0 +1,71 @@
+import contextlib
+import queue
+import threading
+
+class BatchPrefetcher():
+    """Draws the minibatches of the next learn as soon as the current one is done, on
+    the learner's thread with the memory's seeded rng, and gathers their experiences
+    on a background thread while the env steps in between run. Without background the
+    gather happens right away instead, so a replay_seed gives the same batches either way.
+    The memory's lock stays held from the draw until the gather is done, so
+    add_experience can't overwrite a drawn slot before it is read. The memory gets a
+    real lock for that if it doesn't have one; one that doesn't lock at all (the
+    sharded memory locks each shard itself) is sampled without it"""
+    def __init__(self,memory,draw,gather,background = True):
+        if background and isinstance(getattr(memory,'lock',None),contextlib.nullcontext):
+            memory.lock = threading.Lock()
+        self.lock = getattr(memory,'lock',None) if background else None
+        self.draw = draw
+        self.gather = gather
+        self.background = background
+        self.batches = None # the next learn's, or a queue the thread puts them in
+        if background:
+            self.requests = queue.Queue()
+            self.thread = threading.Thread(target = self._run,daemon = True)
+            self.thread.start()
+
+    def request(self,count):
+        """Draw count minibatches for the next get"""
+        if self.lock is not None:
+            self.lock.acquire() # released by the thread once it has gathered them
+        try:
+            drawn = [self.draw() for i in range(count)]
+        except Exception:
+            if self.lock is not None:
+                self.lock.release()
+            raise
+        if self.background:
+            self.batches = queue.Queue(maxsize = 1)
+            self.requests.put((drawn,self.batches))
+        else:
+            self.batches = [self.gather(batch) for batch in drawn]
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            drawn, batches = request
+            try:
+                gathered = [self.gather(batch) for batch in drawn]
+            except Exception as error:
+                gathered = error # raised again by get on the learner's thread
+            finally:
+                if self.lock is not None:
+                    self.lock.release()
+            batches.put(gathered)
+
+    def get(self,count):
+        """The count minibatches requested last, drawing them now if none were"""
+        if self.batches is None:
+            self.request(count)
+        batches = self.batches.get() if self.background else self.batches
+        self.batches = None
+        if isinstance(batches,Exception):
+            raise batches
+        return batches
+
+    def close(self):
+        if self.background:
+            self.requests.put(None)
+            self.thread.join()
@@ -0,0 +1,52 @@
+class Scheduler():
+    """When the agent learns, how often the target network syncs and what epsilon is.
+    Every setting is a key in the session config, see from_config:
+        updates_per_step      gradient updates per env step, .25 is one update every 4 steps
+        fused_updates         gradient updates run back to back in one compiled call
+        target_sync_interval  updates between copies of the model into the target model
+        starting_epsilon, epsilon_min, epsilon_decay and epsilon_decay_unit
+                              epsilon falls linearly by epsilon_decay per 'learns'
+                              (gradient update) or per 'steps' (env step) down to epsilon_min"""
+    def __init__(self,\
+                updates_per_step = 1,\
+                fused_updates = 1,\
+                target_sync_interval = 10000,\
+                starting_epsilon = 1,\
+                epsilon_min = .05,\
+                epsilon_decay = .9/100000,\
+                epsilon_decay_unit = 'learns'):
+        if epsilon_decay_unit not in ('learns', 'steps'):
+            raise ValueError('epsilon_decay_unit must be learns or steps')
+        self.updates_per_step = updates_per_step
+        self.fused_updates = fused_updates
+        self.target_sync_interval = target_sync_interval
+        self.starting_epsilon = starting_epsilon
+        self.epsilon_min = epsilon_min
+        self.epsilon_decay = epsilon_decay
+        self.epsilon_decay_unit = epsilon_decay_unit
+        self.credit = 0 # gradient updates owed but not run yet
+
+    @classmethod
+    def from_config(cls,config):
+        return cls(config['updates_per_step']\
+                    ,config['fused_updates']\
+                    ,config['target_sync_interval']\
+                    ,config['starting_epsilon']\
+                    ,config['epsilon_min']\
+                    ,config['epsilon_decay']\
+                    ,config['epsilon_decay_unit'])
+
+    def learn_calls(self,env_steps = 1):
+        """How many times to call agent.learn after env_steps more steps. Each call runs
+        fused_updates gradient updates, the remainder carries over to later steps"""
+        self.credit += env_steps * self.updates_per_step
+        calls = int(self.credit // self.fused_updates)
+        self.credit -= calls * self.fused_updates
+        return calls
+
+    def epsilon(self,learns,timesteps):
+        progress = learns if self.epsilon_decay_unit == 'learns' else timesteps
+        return max(self.epsilon_min, self.starting_epsilon - self.epsilon_decay * progress)
+
+    def target_sync_due(self,previous_learns,learns):
+        return learns // self.target_sync_interval != previous_learns // self.target_sync_interval
@@ -0,0 +1,39 @@
+import numpy as np
+
+class SumTree():
+    """Binary tree of priority sums kept in one flat array. Node i has children 2i
+    and 2i+1, the root at node 1 holds the total and the leaves start at capacity,
+    so sampling and updates touch one node per level, all levels vectorized over
+    the batch"""
+    def __init__(self,size):
+        self.size = size
+        self.capacity = 1 << max(size - 1,1).bit_length() # leaves, a power of 2 >= size
+        self.depth = self.capacity.bit_length() - 1
+        self.nodes = np.zeros(2 * self.capacity,dtype = np.float64)
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self,indices):
+        return self.nodes[np.asarray(indices) + self.capacity]
+
+    def update(self,indices,priorities):
+        """Set the priority of each leaf and recompute the sums above it. Parents are
+        rebuilt from their children rather than adjusted, so repeated indices are fine
+        and rounding errors never pile up"""
+        nodes = np.asarray(indices) + self.capacity
+        self.nodes[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = nodes // 2
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+    def find(self,values):
+        """Leaf index whose cumulative priority range holds each value in [0, total)"""
+        values = np.array(values,dtype = np.float64)
+        nodes = np.ones(len(values),dtype = np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.nodes[left]
+            values -= self.nodes[left] * go_right
+            nodes = left + go_right
+        return nodes - self.capacity
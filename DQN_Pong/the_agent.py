@@ -1,9 +1,12 @@
 from tensorflow.keras.models import Sequential, clone_model
-from tensorflow.keras.layers import Dense, Flatten, Conv2D, Input
+from tensorflow.keras.layers import Dense, Flatten, Conv2D, Input, Rescaling
 from tensorflow.keras.optimizers import Adam
 import keras.backend as K
 import tensorflow as tf
 from agent_memory import Memory
+from scheduler import Scheduler
+from replay_prefetch import BatchPrefetcher
+from phase_timers import PhaseTimers
 import numpy as np
 import random
 
@@ -17,16 +20,32 @@ class Agent():
                 learn_rate,\
                 starting_lives = 5,\
                 debug = False,\
-                resume_model = None):
-        self.memory = Memory(max_mem_len)
+                resume_model = None,\
+                memory = None,\
+                priority_beta = .4,\
+                scheduler = None,\
+                prefetch = False,\
+                seed = None,\
+                timers = None):
+        if (memory == None):
+            memory = Memory(max_mem_len,seed = seed)
+        self.memory = memory
         self.possible_actions = possible_actions
+        self.action_indices = np.zeros(max(possible_actions) + 1,dtype = np.int64) # action -> output index
+        self.action_indices[possible_actions] = np.arange(len(possible_actions))
+        if (scheduler == None):
+            scheduler = Scheduler(starting_epsilon = starting_epsilon)
+        self.scheduler = scheduler # learn cadence, target syncs and epsilon
         self.epsilon = starting_epsilon
-        self.epsilon_decay = .9/100000
-        self.epsilon_min = .05
         self.gamma = .95
+        self.priority_beta = priority_beta # importance sampling correction, annealed to 1
+        self.priority_beta_increment = .6/100000
         self.learn_rate = learn_rate
+        self.loss = tf.keras.losses.Huber()
         if (resume_model == None):
             self.model = self._build_model()
+        elif (tf.as_dtype(resume_model.inputs[0].dtype) != tf.uint8):
+            self.model = self._migrate_model(resume_model)
         else:
             self.model = resume_model
         self.model_target = clone_model(self.model)
@@ -34,11 +53,18 @@ class Agent():
         self.lives = starting_lives #this parameter does not apply to pong
         self.starting_mem_len = starting_mem_len
         self.learns = 0
+        if (timers == None):
+            timers = PhaseTimers()
+        self.timers = timers # per phase time of the training loop, see phase_timers
+        self.step_metrics = None # loggers.MetricsWriter for per step metrics, if any
+        self.prefetch = prefetch # gather the next learn's minibatches on a background thread
+        self.prefetcher = None # started by the first learn, once memory can be sampled
 
 
     def _build_model(self):
         model = Sequential()
-        model.add(Input((84,84,4)))
+        model.add(Input((84,84,4),dtype = 'uint8'))
+        model.add(Rescaling(1/255)) # frames stay uint8 until they are inside the network
         model.add(Conv2D(filters = 32\
                         ,kernel_size = (8,8)\
                         ,strides = 4\
@@ -72,65 +98,122 @@ class Agent():
         print('\nAgent Initialized\n')
         return model
 
+    def _migrate_model(self,saved_model):
+        """Models saved before the network took uint8 input expect frames already divided
+        by 255. The rescaling layer has no weights, so we copy theirs into a new network.
+        The optimizer starts fresh"""
+        model = self._build_model()
+        model.set_weights(saved_model.get_weights())
+        print('\nSaved model migrated to uint8 input\n')
+        return model
+
     def get_action(self,state):
         """Explore"""
         if np.random.rand() < self.epsilon:
             return random.sample(self.possible_actions,1)[0]
 
         """Do Best Acton"""
-        a_index = np.argmax(self.model.predict(state))
+        start = self.timers.now()
+        a_index = np.argmax(self._predict(tf.constant(state,dtype = tf.uint8)))
+        self.timers.lap('greedy_action',start)
         return self.possible_actions[a_index]
 
-    def _index_valid(self,index):
-        if self.memory.done_flags[index-3] or self.memory.done_flags[index-2] or self.memory.done_flags[index-1] or self.memory.done_flags[index]:
-            return False
-        else:
-            return True
+    def get_actions(self,states):
+        """get_action for a batch of states, one per environment, with a single forward
+        pass shared by every environment that isn't exploring"""
+        actions = np.array(self.possible_actions)[np.random.randint(len(self.possible_actions),size = len(states))]
+        greedy = np.random.rand(len(states)) >= self.epsilon
+        if greedy.any():
+            start = self.timers.now()
+            a_indices = np.argmax(self._predict(tf.constant(states,dtype = tf.uint8)),axis = 1)
+            self.timers.lap('greedy_action',start)
+            actions[greedy] = np.array(self.possible_actions)[a_indices[greedy]]
+        return actions
+
+    @tf.function(input_signature = [tf.TensorSpec((None,84,84,4),tf.uint8)])
+    def _predict(self,state):
+        """Direct compiled forward pass, predict() builds a data pipeline on every call"""
+        return self.model(state,training = False)
+
+    def _train_step(self,states,actions,next_rewards,next_states,next_done_flags,weights):
+        """Get the ouputs from our model and the target model, build the labels and
+        take one optimizer step.
+        The label for output[action_taken] is R_(t+1) + Qmax_(t+1), every other output
+        is labelled with its own prediction so it adds no error to the Huber loss.
+        Each sample's loss is scaled by its importance sampling weight, and the TD
+        errors are returned for prioritized replay"""
+        next_state_values = tf.reduce_max(self.model_target(next_states,training = False),axis = 1)
+        targets = next_rewards + (1 - next_done_flags) * self.gamma * next_state_values
+        mask = tf.one_hot(actions,len(self.possible_actions))
+        with tf.GradientTape() as tape:
+            outputs = self.model(states,training = True)
+            labels = tf.stop_gradient(outputs + mask * (tf.expand_dims(targets,1) - outputs))
+            loss = self.loss(labels,outputs,sample_weight = weights)
+        gradients = tape.gradient(loss,self.model.trainable_variables)
+        self.model.optimizer.apply_gradients(zip(gradients,self.model.trainable_variables))
+        return targets - tf.reduce_sum(mask * outputs,axis = 1)
+
+    @tf.function
+    def _train_steps(self,states,actions,next_rewards,next_states,next_done_flags,weights):
+        """_train_step for each of a stack of minibatches, all inside a single graph call"""
+        td_errors = []
+        for i in range(states.shape[0]):
+            td_errors.append(self._train_step(states[i],actions[i],next_rewards[i],next_states[i],next_done_flags[i],weights[i]))
+        return tf.stack(td_errors)
 
     def learn(self,debug = False):
         """we want the output[a] to be R_(t+1) + Qmax_(t+1)."""
         """So target for taking action 1 should be [output[0], R_(t+1) + Qmax_(t+1), output[2]]"""
 
-        """First we need 32 random valid indicies"""
-        states = []
-        next_states = []
-        actions_taken = []
-        next_rewards = []
-        next_done_flags = []
-
-        while len(states) < 32:
-            index = np.random.randint(4,len(self.memory.frames) - 1)
-            if self._index_valid(index):
-                state = [self.memory.frames[index-3], self.memory.frames[index-2], self.memory.frames[index-1], self.memory.frames[index]]
-                state = np.moveaxis(state,0,2)/255
-                next_state = [self.memory.frames[index-2], self.memory.frames[index-1], self.memory.frames[index], self.memory.frames[index+1]]
-                next_state = np.moveaxis(next_state,0,2)/255
-
-                states.append(state)
-                next_states.append(next_state)
-                actions_taken.append(self.memory.actions[index])
-                next_rewards.append(self.memory.rewards[index+1])
-                next_done_flags.append(self.memory.done_flags[index+1])
-
-        """Now we get the ouputs from our model, and the target model. We need this for our target in the error function"""
-        labels = self.model.predict(np.array(states))
-        next_state_values = self.model_target.predict(np.array(next_states))
-        
-        """Now we define our labels, or what the output should have been
-           We want the output[action_taken] to be R_(t+1) + Qmax_(t+1) """
-        for i in range(32):
-            action = self.possible_actions.index(actions_taken[i])
-            labels[i][action] = next_rewards[i] + (not next_done_flags[i]) * self.gamma * max(next_state_values[i])
-
-        """Train our model using the states and outputs generated"""
-        self.model.fit(np.array(states),labels,batch_size = 32, epochs = 1, verbose = 0)
-
-        """Decrease epsilon and update how many times our agent has learned"""
-        if self.epsilon > self.epsilon_min:
-            self.epsilon -= self.epsilon_decay
-        self.learns += 1
+        """First we need 32 random valid indicies for each of the scheduler's fused updates"""
+        start = self.timers.now()
+        if self.prefetcher is None:
+            self.prefetcher = BatchPrefetcher(self.memory,self._draw_batch,self._gather_batch,self.prefetch)
+        batches = self.prefetcher.get(self.scheduler.fused_updates)
+        states, actions_taken, next_rewards, next_states, next_done_flags, indices, weights = zip(*batches)
+        start = self.timers.lap('sample',start)
+
+        """Now we fit the model in one compiled call, see _train_steps"""
+        actions = self.action_indices[np.stack(actions_taken)]
+        td_errors = self._train_steps(tf.constant(np.stack(states),dtype = tf.uint8)\
+                                    ,tf.constant(actions,dtype = tf.int32)\
+                                    ,tf.constant(np.stack(next_rewards),dtype = tf.float32)\
+                                    ,tf.constant(np.stack(next_states),dtype = tf.uint8)\
+                                    ,tf.constant(np.stack(next_done_flags),dtype = tf.float32)\
+                                    ,tf.constant(np.stack(weights),dtype = tf.float32))
+
+        """Sampled transitions get their new TD errors as priorities"""
+        if self.memory.priorities is not None:
+            self.memory.update_priorities(np.concatenate(indices),td_errors.numpy().ravel())
+        start = self.timers.lap('train',start)
+
+        """Draw the next learn's minibatches now, see replay_prefetch"""
+        self.prefetcher.request(self.scheduler.fused_updates)
+        start = self.timers.extend('sample',start)
+
+        """Update how many times our agent has learned and decrease epsilon"""
+        previous_learns = self.learns
+        self.learns += self.scheduler.fused_updates
+        self.update_epsilon()
         
-        """Every 10000 learned, copy our model weights to our target model"""
-        if self.learns % 10000 == 0:
+        """Every target_sync_interval learns, copy our model weights to our target model"""
+        if self.scheduler.target_sync_due(previous_learns,self.learns):
             self.model_target.set_weights(self.model.get_weights())
             print('\nTarget model updated')
+            self.timers.lap('target_sync',start)
+
+    def _draw_batch(self):
+        """What memory.gather needs for a minibatch, the sampled slots if they get new
+        priorities and the importance sampling weights"""
+        if self.memory.priorities is None:
+            return self.memory.draw(32), None, np.ones(32)
+        indices, weights = self.memory.draw_prioritized(32,self.priority_beta)
+        self.priority_beta = min(1,self.priority_beta + self.priority_beta_increment)
+        return indices, indices, weights
+
+    def _gather_batch(self,drawn):
+        draw, indices, weights = drawn
+        return self.memory.gather(draw) + (indices, weights)
+
+    def update_epsilon(self):
+        self.epsilon = self.scheduler.epsilon(self.learns,self.total_timesteps)
@@ -0,0 +1,74 @@
+import multiprocessing as mp
+import time
+import numpy as np
+import gym
+import preprocess_frame as ppf
+
+
+def _run_env(name, connection):
+    """Worker loop: owns one env and sends back preprocessed frames, so only 84x84
+    frames cross the pipe. A game that ended on the last step starts over on this one"""
+    env = gym.make(name, render_mode='rgb_array')
+    needs_reset = True
+    while True:
+        command, action = connection.recv()
+        if command == 'step':
+            if needs_reset:
+                env.reset()
+                next_frame = env.step(0)[0]
+                next_frames_reward, next_frame_terminal, new_game = 0, False, True
+            else:
+                next_frame, next_frames_reward, next_frame_terminal, info = env.step(action)
+                new_game = False
+            needs_reset = next_frame_terminal
+            connection.send((ppf.resize_frame(next_frame), next_frames_reward, next_frame_terminal, new_game))
+        elif command == 'close':
+            env.close()
+            connection.close()
+            break
+
+class VectorEnv():
+    """num_envs Pong environments stepped in lockstep in parallel worker processes.
+    Also keeps each env's current action, score, step count and start time for the episode loop"""
+    def __init__(self, name, num_envs):
+        self.num_envs = num_envs
+        # fork, so the workers don't re-import tensorflow. They never use it, but build
+        # this before the agent anyway so no tensorflow threads exist when we fork
+        context = mp.get_context('fork')
+        self.connections = []
+        self.processes = []
+        for i in range(num_envs):
+            parent, child = context.Pipe()
+            process = context.Process(target=_run_env, args=(name, child), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        self.actions = np.zeros(num_envs, dtype=np.int64)
+        self.scores = np.zeros(num_envs)
+        self.episode_steps = np.zeros(num_envs, dtype=np.int64)
+        self.episode_start = np.full(num_envs, time.time())
+
+    def step(self, actions):
+        """Step every env with its action. Returns stacked frames, rewards, done flags and
+        which envs started a new game on this step instead of acting"""
+        for connection, action in zip(self.connections, actions):
+            connection.send(('step', action))
+        results = [connection.recv() for connection in self.connections]
+        next_frames = np.stack([result[0] for result in results])
+        next_rewards = np.array([result[1] for result in results], dtype=np.float64)
+        next_dones = np.array([result[2] for result in results], dtype=np.bool_)
+        new_games = np.array([result[3] for result in results], dtype=np.bool_)
+
+        self.scores[new_games] = 0
+        self.episode_steps[new_games] = 0
+        self.episode_start[new_games] = time.time()
+        self.scores += next_rewards
+        self.episode_steps += 1
+        return next_frames, next_rewards, next_dones, new_games
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(('close', None))
+        for process in self.processes:
+            process.join()
@@ -7,6 +7,7 @@ import json
 from datetime import datetime
 import time
 import csv
+import multiprocessing as mp
 
 ################ Image Preprocessing  ###################
 
@@ -30,6 +31,13 @@ def preprocess_observations(input_observation, prev_processed_observation, input
     return input_observation, prev_processed_observations
 
 
+def sparse_observation(observation):
+    # The difference frame is almost all zeros and the rest are +1 or -1, so keep just the
+    # indices of the nonzero entries and their values
+    indices = np.flatnonzero(observation)
+    return indices.astype(np.min_scalar_type(observation.size)), observation[indices].astype(np.int8)
+
+
 def remove_background(image):
     image[image == 144] = 0
     image[image == 109] = 0
@@ -57,7 +65,19 @@ def relu(vector):
 
 def neural_net(observation_matrix, weights):
     # Compute the new hidden layer values and the new output layer values using the observation_matrix and weights 
-    hidden_layer_values = np.dot(weights['1'], observation_matrix)
+    # observation_matrix is one observation, or one per row for several envs stepped together
+    hidden_layer_values = np.dot(observation_matrix, weights['1'].T)
+    hidden_layer_values = relu(hidden_layer_values)
+    output_layer_values = np.dot(hidden_layer_values, weights['2'])
+    output_layer_values = sigmoid(output_layer_values)
+    return hidden_layer_values, output_layer_values
+
+def neural_net_sparse(observations, weights):
+    # neural_net for a list of sparse_observation's, one per env: each hidden value is the sum of
+    # the weights of the few nonzero inputs, signed
+    hidden_layer_values = np.empty((len(observations), len(weights['2'])))
+    for row, (indices, values) in enumerate(observations):
+        hidden_layer_values[row] = np.dot(weights['1'][:, indices], values)
     hidden_layer_values = relu(hidden_layer_values)
     output_layer_values = np.dot(hidden_layer_values, weights['2'])
     output_layer_values = sigmoid(output_layer_values)
@@ -77,12 +97,35 @@ def compute_gradient(gradient_log_p, hidden_layer_values, observation_values, we
     dC_dw2 = np.dot(hidden_layer_values.T, delta_L).ravel()
     delta_l2 = np.outer(delta_L, weights['2'])
     delta_l2 = relu(delta_l2)
-    dC_dw1 = np.dot(delta_l2.T, observation_values)
+    if observation_values.dtype == np.float64:
+        dC_dw1 = np.dot(delta_l2.T, observation_values)
+    else: # compact observations (see EpisodeBuffer) are multiplied in float32 a chunk of steps at a time
+        dC_dw1 = np.zeros((delta_l2.shape[1], observation_values.shape[1]))
+        for start in range(0, len(observation_values), 512):
+            dC_dw1 += np.dot(delta_l2[start:start + 512].T.astype(np.float32), observation_values[start:start + 512].astype(np.float32))
     return {
         '1': dC_dw1,
         '2': dC_dw2
     }
 
+def compute_gradient_sparse(gradient_log_p, hidden_layer_values, observations, weights):
+    # compute_gradient for an episode of sparse_observation's, given as (offsets, indices, values)
+    # with step t's entries at offsets[t]:offsets[t + 1] (see EpisodeBuffer). Each step only adds
+    # its delta_l2 row to the columns of its nonzero inputs, instead of a dense episode_length x 6400 product
+    offsets, indices, values = observations
+    delta_L = gradient_log_p
+    dC_dw2 = np.dot(hidden_layer_values.T, delta_L).ravel()
+    delta_l2 = np.outer(delta_L, weights['2'])
+    delta_l2 = relu(delta_l2)
+    dC_dw1 = np.zeros(weights['1'].shape[::-1]) # transposed, so a column is a contiguous row
+    for step in range(len(delta_l2)):
+        start, end = offsets[step], offsets[step + 1]
+        dC_dw1[indices[start:end]] += values[start:end, None] * delta_l2[step]
+    return {
+        '1': dC_dw1.T,
+        '2': dC_dw2
+    }
+
 def weights_update(weights, expectation_g_squared, g_dict, decay_rate, learning_rate):
     epsilon = 1e-5
     for layer_name in weights.keys():
@@ -96,13 +139,17 @@ def weights_update(weights, expectation_g_squared, g_dict, decay_rate, learning_
 
 def discount_rewards(rewards, gamma):
    # Actions you took 20 steps before the end result are less important to the overall result than an action you took a step ago. This implements that logic by discounting the reward on previous actions based on how long ago they were taken
-    discounted_rewards = np.zeros_like(rewards)
-    running_add = 0
-    for t in reversed(range(0, rewards.size)):
-        if rewards[t] != 0:
-            running_add = 0 # reset the sum, since this was a game boundary (pong specific!)
-        running_add = running_add * gamma + rewards[t]
-        discounted_rewards[t] = running_add
+   # A nonzero reward is a game boundary (pong specific!) where the sum resets, so each step's
+   # discounted reward is just the next nonzero reward, discounted by how many steps away it is.
+   # Steps after the last one get 0
+    discounted_rewards = np.zeros(rewards.shape)
+    rewards = rewards.ravel()
+    boundaries = np.flatnonzero(rewards)
+    steps = np.arange(rewards.size)
+    next_boundary = np.searchsorted(boundaries, steps)
+    scored = next_boundary < boundaries.size
+    boundary = boundaries[next_boundary[scored]]
+    discounted_rewards.ravel()[scored] = rewards[boundary] * gamma ** (boundary - steps[scored])
     return discounted_rewards
 
 def discount_plus_rewards(gradient_log_p, episode_rewards, gamma):
@@ -113,25 +160,196 @@ def discount_plus_rewards(gradient_log_p, episode_rewards, gamma):
     discounted_episode_rewards /= np.std(discounted_episode_rewards)
     return gradient_log_p * discounted_episode_rewards
 
+class EpisodeBuffer():
+    """One episode's steps in arrays that are allocated once and doubled when full, instead of
+    lists of per step arrays vstacked into new float64 matrices when the episode ends. The
+    difference frames are only -1, 0 or 1, so they're kept as int8, or with sparse as the
+    indices and values of their nonzero entries, and hidden values and rewards are kept as
+    float32. The accessors return views of the steps so far, and clear keeps the arrays for
+    the next episode"""
+    def __init__(self, input_dimensions, num_hidden_layer_neurons, sparse=False, capacity=1024):
+        self.input_dimensions = input_dimensions
+        self.sparse = sparse
+        self.steps = 0
+        self._hidden_layer_values = np.empty((capacity, num_hidden_layer_neurons), dtype=np.float32)
+        self._gradient_log_ps = np.empty((capacity, 1))
+        self._rewards = np.empty((capacity, 1), dtype=np.float32)
+        if sparse:
+            self._offsets = np.zeros(capacity + 1, dtype=np.int64)
+            self._indices = np.empty(capacity * 16, dtype=np.min_scalar_type(input_dimensions))
+            self._values = np.empty(capacity * 16, dtype=np.int8)
+        else:
+            self._observations = np.empty((capacity, input_dimensions), dtype=np.int8)
+
+    def _grow(self, array, size):
+        grown = np.empty((size,) + array.shape[1:], dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def append(self, observation, hidden_layer_values, gradient_log_p, reward):
+        step = self.steps
+        if step == len(self._rewards):
+            self._hidden_layer_values = self._grow(self._hidden_layer_values, 2 * step)
+            self._gradient_log_ps = self._grow(self._gradient_log_ps, 2 * step)
+            self._rewards = self._grow(self._rewards, 2 * step)
+            if self.sparse:
+                self._offsets = self._grow(self._offsets, 2 * step + 1)
+            else:
+                self._observations = self._grow(self._observations, 2 * step)
+        if self.sparse:
+            indices, values = observation
+            start = self._offsets[step]
+            end = start + len(indices)
+            if end > len(self._indices):
+                self._indices = self._grow(self._indices, max(2 * len(self._indices), end))
+                self._values = self._grow(self._values, len(self._indices))
+            self._indices[start:end] = indices
+            self._values[start:end] = values
+            self._offsets[step + 1] = end
+        else:
+            self._observations[step] = observation
+        self._hidden_layer_values[step] = hidden_layer_values
+        self._gradient_log_ps[step] = gradient_log_p
+        self._rewards[step] = reward
+        self.steps += 1
+
+    def observations(self):
+        # (steps, input_dimensions) int8, or with sparse (offsets, indices, values) for compute_gradient_sparse
+        if self.sparse:
+            return self._offsets[:self.steps + 1], self._indices[:self._offsets[self.steps]], self._values[:self._offsets[self.steps]]
+        return self._observations[:self.steps]
+
+    def hidden_layer_values(self):
+        return self._hidden_layer_values[:self.steps]
+
+    def gradient_log_ps(self):
+        return self._gradient_log_ps[:self.steps]
+
+    def rewards(self):
+        return self._rewards[:self.steps]
+
+    def nbytes(self):
+        # bytes the steps so far take up
+        observations = self.observations()
+        if self.sparse:
+            observations = sum(array.nbytes for array in observations)
+        else:
+            observations = observations.nbytes
+        return observations + self.hidden_layer_values().nbytes + self.gradient_log_ps().nbytes + self.rewards().nbytes
+
+    def clear(self):
+        self.steps = 0
+
+def episode_gradient(episode, weights, gamma):
+    # the gradient of a finished EpisodeBuffer's episode
+    # Tweak the gradient of the log_ps based on the discounted rewards
+    episode_gradient_log_ps_discounted = discount_plus_rewards(episode.gradient_log_ps(), episode.rewards(), gamma)
+    if episode.sparse:
+        return compute_gradient_sparse(episode_gradient_log_ps_discounted, episode.hidden_layer_values(), episode.observations(), weights)
+    return compute_gradient(
+      episode_gradient_log_ps_discounted,
+      episode.hidden_layer_values(),
+      episode.observations(),
+      weights
+    )
+
 class NumpyArrayEncoder(JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.ndarray):
             return obj.tolist()
         return JSONEncoder.default(self, obj)
 
-def openOrCreateWeights(defaultWeights, filename):
-    weights = defaultWeights
-    try:
-        jsonFile = open(filename, 'r')
-        weightsJSONSerialized = jsonFile.read()
-        weights = json.loads(weightsJSONSerialized)
-        weights['1'] = np.asarray(weights['1'])
-        weights['2'] = np.asarray(weights['2'])
-    except:
-        saveWeights(weights, filename)
-    
+CHECKPOINT_MAGIC = b'RLNNCKP1'
+
+def saveCheckpoint(state, filename):
+    # state is a dictionary of dictionaries of arrays, like {'weights': weights, 'g_dict': g_dict}
+    # One binary file: magic, header length, a json header with every array's name, dtype, shape
+    # and offset, then the arrays 64 byte aligned. It's written under a temporary name and renamed
+    # over filename, so a crash mid-write leaves the previous checkpoint whole
+    arrays = [(group+'/'+name, np.ascontiguousarray(array)) for group in state for name, array in state[group].items()]
+    entries = []
+    offset = 0
+    for name, array in arrays:
+        entries.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset += -(-array.nbytes // 64) * 64
+    header = json.dumps(entries).encode()
+    start = -(-(len(CHECKPOINT_MAGIC) + 8 + len(header)) // 64) * 64
+    with open(filename+'.tmp', 'wb') as file:
+        file.write(CHECKPOINT_MAGIC + np.uint64(len(header)).tobytes() + header)
+        for entry, (name, array) in zip(entries, arrays):
+            file.seek(start + entry['offset'])
+            file.write(array.data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(filename+'.tmp', filename)
+    return True
+
+def openCheckpoint(filename):
+    # Maps the file copy-on-write: nothing is read until it's used, and the arrays can be
+    # updated in place (weights_update does) without touching the file
+    data = np.memmap(filename, dtype=np.uint8, mode='c')
+    if bytes(data[:8]) != CHECKPOINT_MAGIC:
+        raise ValueError(filename+' is not a checkpoint')
+    length = int(data[8:16].view(np.uint64)[0])
+    start = -(-(16 + length) // 64) * 64
+    state = {}
+    for entry in json.loads(bytes(data[16:16 + length])):
+        group, name = entry['name'].split('/')
+        dtype = np.dtype(entry['dtype'])
+        end = start + entry['offset'] + int(np.prod(entry['shape'])) * dtype.itemsize
+        state.setdefault(group, {})[name] = data[start + entry['offset']:end].view(dtype).reshape(entry['shape'])
+    return state
+
+def emptyRmspropState(weights):
+    return {name: np.zeros_like(weights[name]) for name in weights}
+
+def openOrCreateCheckpoint(defaultWeights, filename, jsonFilename):
+    # weights and rmsprop state from the session's checkpoint, converting the json weights of
+    # sessions from before checkpoints, or the default weights for a new session. Anything that
+    # fails to load raises rather than quietly starting over from random weights
+    if (not os.path.exists(filename)):
+        if (os.path.exists(jsonFilename)):
+            convertJsonWeights(jsonFilename, filename)
+        else:
+            saveCheckpoint({'weights': defaultWeights
+                            , 'expectation_g_squared': emptyRmspropState(defaultWeights)
+                            , 'g_dict': emptyRmspropState(defaultWeights)}, filename)
+    start = time.time()
+    state = openCheckpoint(filename)
+    print('Loaded %s (%.1f MB) in %.1f ms' % (filename, os.path.getsize(filename) / 1e6, (time.time() - start) * 1000))
+    return state
+
+def openJsonWeights(filename):
+    jsonFile = open(filename, 'r')
+    weights = json.loads(jsonFile.read())
+    jsonFile.close()
+    weights['1'] = np.asarray(weights['1'])
+    weights['2'] = np.asarray(weights['2'])
     return weights
-       
+
+def convertJsonWeights(jsonFilename, filename):
+    # One time conversion of a session's json weights to a checkpoint. Json sessions never
+    # saved the rmsprop state, so it starts from zero like it did when they were resumed.
+    # Prints how the two formats compare
+    start = time.time()
+    weights = openJsonWeights(jsonFilename)
+    jsonLoad = time.time() - start
+    start = time.time()
+    saveWeights(weights, jsonFilename+'.timing')
+    jsonSave = time.time() - start
+    os.remove(jsonFilename+'.timing')
+    start = time.time()
+    saveCheckpoint({'weights': weights, 'expectation_g_squared': emptyRmspropState(weights), 'g_dict': emptyRmspropState(weights)}, filename)
+    save = time.time() - start
+    start = time.time()
+    state = openCheckpoint(filename)
+    np.add.reduce(state['weights']['1'], axis=None) # touch every page, so it isn't just the mapping timed
+    load = time.time() - start
+    print('Converted %s to %s' % (jsonFilename, filename))
+    print('json:       %.1f MB, save %.0f ms, load %.0f ms (weights only)' % (os.path.getsize(jsonFilename) / 1e6, jsonSave * 1000, jsonLoad * 1000))
+    print('checkpoint: %.1f MB, save %.0f ms, load %.0f ms (weights and rmsprop state)' % (os.path.getsize(filename) / 1e6, save * 1000, load * 1000))
+    return True
+
 def saveWeights(weights, filename):
     weightsJSONSerialized = json.dumps(weights, cls=NumpyArrayEncoder)
     jsonFile = open(filename,'w')
@@ -139,22 +357,96 @@ def saveWeights(weights, filename):
     jsonFile.close()
     return True
 
-def saveEpisodeHistory(episodeData, filename):
+class MetricsWriter():
+    """Keeps metric rows in memory and appends them to a csv file (format 'csv') or
+    to one raw file per column in a folder (format 'binary'), every maxRows rows or
+    maxSeconds seconds and on close. The columns are the first row's keys. Use it in
+    a with block or call close, so the rows held are written when interrupted"""
+    def __init__(self, filenameAndPath, maxRows=100, maxSeconds=30, format='csv'):
+        if format not in ('csv', 'binary'):
+            raise ValueError('format must be csv or binary')
+        self.filenameAndPath = filenameAndPath
+        self.maxRows = maxRows
+        self.maxSeconds = maxSeconds
+        self.format = format
+        self.columns = None # column name -> values not written yet
+        self.dtypes = None
+        self.rows = 0
+        self.lastFlush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def _start(self, row):
+        self.columns = {name: [] for name in row}
+        self.dtypes = {name: np.asarray(value).dtype for name, value in row.items()}
+        if self.format == 'binary':
+            for name, dtype in self.dtypes.items():
+                if dtype.kind not in 'biuf':
+                    raise ValueError('binary metrics must be numbers, '+name+' is '+str(dtype))
+            schemaFilename = os.path.join(self.filenameAndPath, 'columns.json')
+            if os.path.exists(schemaFilename): # a resumed session appends to the same columns
+                with open(schemaFilename, 'r') as file:
+                    schema = json.load(file)
+                if list(schema) != list(self.columns):
+                    raise ValueError(schemaFilename+' has columns '+str(list(schema)))
+                self.dtypes = {name: np.dtype(dtype) for name, dtype in schema.items()}
+            else:
+                os.makedirs(self.filenameAndPath, exist_ok=True)
+                with open(schemaFilename, 'w') as file:
+                    json.dump({name: dtype.str for name, dtype in self.dtypes.items()}, file)
+        else:
+            self.filenameAndPath = self._csvFor([str(name) for name in self.columns])
+
+    def _csvFor(self, header):
+        """The csv file to append rows with these columns to: the one asked for unless it has
+        another header row, as when resuming an older session or switching between sync
+        and async training. Then the first of name_2.csv, name_3.csv.. that is new or matches"""
+        stem, extension = os.path.splitext(self.filenameAndPath)
+        filename, number = self.filenameAndPath, 1
+        while os.path.exists(filename):
+            with open(filename, 'r', newline='') as file:
+                if next(csv.reader(file), None) in (header, None):
+                    break
+            number += 1
+            filename = stem+'_'+str(number)+extension
+        if filename != self.filenameAndPath:
+            print(self.filenameAndPath+' has other columns, appending to '+filename)
+        return filename
+
+    def write(self, row):
+        if self.columns is None:
+            self._start(row)
+        for name, values in self.columns.items():
+            values.append(row[name])
+        self.rows += 1
+        if self.rows >= self.maxRows or time.time() - self.lastFlush >= self.maxSeconds:
+            self.flush()
+
+    def flush(self):
+        self.lastFlush = time.time()
+        if self.rows == 0:
+            return
+        if self.format == 'csv':
+            firstRun = not os.path.exists(self.filenameAndPath) or os.path.getsize(self.filenameAndPath) == 0
+            with open(self.filenameAndPath, 'a', newline='') as file:
+                writer = csv.writer(file)
+                if firstRun:
+                    writer.writerow(self.columns.keys())
+                writer.writerows(zip(*self.columns.values()))
+        else:
+            for name, values in self.columns.items():
+                with open(os.path.join(self.filenameAndPath, name+'.bin'), 'ab') as file:
+                    np.asarray(values, dtype=self.dtypes[name]).tofile(file)
+        for values in self.columns.values():
+            values.clear()
+        self.rows = 0
 
-    headers = ['episode_number', 'reward_sum', 'running_reward']
-    entryData = [episodeData['episode_number']
-                ,episodeData['reward_sum']
-                ,episodeData['running_reward']]
-    firstRun = False
-    if (not os.path.exists(filename)):
-            firstRun = True
-    file = open(filename, 'a')
-    writer = csv.writer(file)
-    if (firstRun):
-        writer.writerow(headers)
-    writer.writerow(entryData)
-    file.close()
-    return True
+    def close(self):
+        self.flush()
 
 def saveTrainingConfig(config,filename):
     JSONSerialized = json.dumps(config, cls=NumpyArrayEncoder)
@@ -168,14 +460,112 @@ def openTrainingConfig(filename):
     configJSONSerialized = jsonFile.read()
     config = json.loads(configJSONSerialized)
     jsonFile.close()
-    config['prev_processed_observations'] = np.asarray(config['prev_processed_observations'])
+    if (config['prev_processed_observations'] != None): # None when the session was saved between episodes
+        config['prev_processed_observations'] = np.asarray(config['prev_processed_observations'])
     return config
 
-#################### The game  ##########################
-def main(silent=False,sessionId=None):
-    env = gym.make("Pong-v0")
-    observation = env.reset() # This gets us the image
+############### Parallel gradient workers ################
+
+# set in each worker process by startGradientWorker
+workerWeights = None
+workerEnv = None
+workerSettings = None
+workerEpisode = None
+
+def playEpisode(env, weights, episode, gamma):
+    # play one episode with weights and return its gradient, reward sum, the bytes its steps
+    # took up and the seconds the gradient took, what main's loop
+    # does for each episode but without rendering or learning. episode is an EpisodeBuffer,
+    # cleared first
+    observation = env.reset()
+    prev_processed_observations = None
+    episode.clear()
+    reward_sum = 0
+    done = False
+    while not done:
+        processed_observations, prev_processed_observations = preprocess_observations(observation, prev_processed_observations, episode.input_dimensions)
+        if episode.sparse:
+            processed_observations = sparse_observation(processed_observations)
+            hidden_layer_values, up_probability = neural_net_sparse([processed_observations], weights)
+            hidden_layer_values, up_probability = hidden_layer_values[0], up_probability[0]
+        else:
+            hidden_layer_values, up_probability = neural_net(processed_observations, weights)
+        action = Move_up_or_down(up_probability)
+        observation, reward, done, info = env.step(action)
+        reward_sum += reward
+        fake_label = 1 if action == 2 else 0
+        episode.append(processed_observations, hidden_layer_values, fake_label - up_probability, reward)
+
+    start = time.time()
+    gradient = episode_gradient(episode, weights, gamma)
+    return gradient, reward_sum, episode.nbytes(), time.time() - start
+
+def sharedWeightViews(sharedArray, shapes):
+    # the weights as arrays viewing one shared block of float64s
+    values = np.frombuffer(sharedArray, dtype=np.float64)
+    weights = {}
+    offset = 0
+    for layer_name, shape in shapes.items():
+        size = int(np.prod(shape))
+        weights[layer_name] = values[offset:offset + size].reshape(shape)
+        offset += size
+    return weights
+
+def startGradientWorker(sharedArray, shapes, input_dimensions, gamma, sparse_observations):
+    # The shared block reaches a worker once, when it starts. Tasks are just seeds
+    global workerWeights, workerEnv, workerSettings, workerEpisode
+    workerWeights = sharedWeightViews(sharedArray, shapes)
+    for layer_name in workerWeights:
+        workerWeights[layer_name].flags.writeable = False # only the parent updates them
+    workerEnv = gym.make("Pong-v0")
+    workerSettings = gamma
+    workerEpisode = EpisodeBuffer(input_dimensions, shapes['2'][0], sparse_observations)
+
+def playGradientEpisode(seed):
+    np.random.seed(seed) # forked workers would otherwise all make the same moves
+    return playEpisode(workerEnv, workerWeights, workerEpisode, workerSettings)
+
+def trainWithWorkers(numWorkers, config, configFilename, checkpointFilename, history, weights, expectation_g_squared, g_dict):
+    # Each batch's episodes are played by a pool of worker processes, all reading the weights
+    # from one shared block. The parent adds up the gradients as they come back, applies
+    # rmsprop to the shared weights in place, which the workers see for the next batch,
+    # and saves the checkpoint and config once per batch
+    shapes = {layer_name: weights[layer_name].shape for layer_name in weights}
+    sharedArray = mp.RawArray('d', sum(int(np.prod(shape)) for shape in shapes.values()))
+    sharedWeights = sharedWeightViews(sharedArray, shapes)
+    for layer_name in weights:
+        sharedWeights[layer_name][...] = weights[layer_name]
+    weights = sharedWeights
+
+    episode_number = config['episode_number']
+    batch_size = config['batch_size']
+    running_reward = config['running_reward']
+    startTime = time.time()
+    episodesPlayed = 0
+    with mp.Pool(numWorkers, startGradientWorker, (sharedArray, shapes, config['input_dimensions'], config['gamma'], config.get('sparse_observations', False))) as pool:
+        while True:
+            seeds = np.random.randint(2**31, size=batch_size - episode_number % batch_size)
+            for gradient, reward_sum, episodeBytes, gradientTime in pool.imap_unordered(playGradientEpisode, seeds):
+                for layer_name in gradient:
+                    g_dict[layer_name] += gradient[layer_name]
+                episode_number += 1
+                episodesPlayed += 1
+                running_reward = reward_sum if running_reward is None else running_reward * 0.99 + reward_sum * 0.01
+                episodesPerHour = episodesPlayed / (time.time() - startTime) * 3600
+                print('episode %d. reward total was %f. running mean: %f. %.1f episodes/hour with %d workers' % (episode_number, reward_sum, running_reward, episodesPerHour, numWorkers))
+                print('episode took %.1f MB, gradient computed in %.0f ms' % (episodeBytes / 1e6, gradientTime * 1000))
+                history.write({'episode_number': episode_number,'reward_sum': reward_sum, 'running_reward': running_reward})
+
+            weights_update(weights, expectation_g_squared, g_dict, config['decay_rate'], config['learning_rate'])
+            saveCheckpoint({'weights': weights, 'expectation_g_squared': expectation_g_squared, 'g_dict': g_dict}, checkpointFilename)
+            config['episode_number'] = episode_number
+            config['reward_sum'] = reward_sum
+            config['running_reward'] = running_reward
+            config['prev_processed_observations'] = None
+            saveTrainingConfig(config,configFilename)
 
+#################### The game  ##########################
+def main(silent=False,sessionId=None,numEnvs=None,numWorkers=None,sparse=None):
     timestamp = datetime.now().strftime("%Y_%m_%d-%I_%M:%S:%p")
 
     isResumingSession = (sessionId != None)
@@ -192,7 +582,8 @@ def main(silent=False,sessionId=None):
     sessionFolderpath = "./session_"+sessionId+"/"
     configFilename = sessionFolderpath+"config_"+sessionId+".json"
     historyFilename = sessionFolderpath+"history_"+sessionId+".json"
-    weightsFilename = sessionFolderpath+"weights_"+sessionId+".json"   
+    weightsFilename = sessionFolderpath+"weights_"+sessionId+".json" # sessions from before checkpoints
+    checkpointFilename = sessionFolderpath+"checkpoint_"+sessionId+".bin"
 
     if(isResumingSession):    
         config = openTrainingConfig(configFilename)
@@ -210,7 +601,16 @@ def main(silent=False,sessionId=None):
         ,   'reward_sum': 0
         ,   'running_reward': None
         ,   'prev_processed_observations': None
+        ,   'num_envs': 1
+        ,   'gradient_workers': 0
+        ,   'sparse_observations': False
         }
+    if (numEnvs != None):
+        config['num_envs'] = numEnvs
+    if (numWorkers != None):
+        config['gradient_workers'] = numWorkers
+    if (sparse != None):
+        config['sparse_observations'] = sparse
     
     # hyperparameters
     episode_number = config['episode_number']
@@ -222,97 +622,123 @@ def main(silent=False,sessionId=None):
     learning_rate = config['learning_rate']
     reward_sum = config['learning_rate']
     running_reward = config['running_reward']
-    prev_processed_observations = config['prev_processed_observations']
+    num_envs = config.get('num_envs', 1) # sessions from before lockstep envs played one
+    gradient_workers = config.get('gradient_workers', 0)
+    sparse_observations = config.get('sparse_observations', False) # see sparse_observation
 
     saveTrainingConfig(config,configFilename)
     defaultWeights = {
         '1': np.random.randn(num_hidden_layer_neurons, input_dimensions) / np.sqrt(input_dimensions),
         '2': np.random.randn(num_hidden_layer_neurons) / np.sqrt(num_hidden_layer_neurons)
     }
-    weights = openOrCreateWeights(defaultWeights,weightsFilename)
+    checkpoint = openOrCreateCheckpoint(defaultWeights,checkpointFilename,weightsFilename)
+    weights = checkpoint['weights']
 
     # To be used with rmsprop algorithm 
-    expectation_g_squared = {}
-    g_dict = {}
-    for layer_name in weights.keys():
-        expectation_g_squared[layer_name] = np.zeros_like(weights[layer_name])
-        g_dict[layer_name] = np.zeros_like(weights[layer_name])
-
-    episode_hidden_layer_values, episode_observations, episode_gradient_log_ps, episode_rewards = [], [], [], []
-
-
-    while True:
-        if(silent):
-            env.render(mode='rgb_array')
-        else:
-            env.render()
-        processed_observations, prev_processed_observations = preprocess_observations(observation, prev_processed_observations, input_dimensions)
-        hidden_layer_values, up_probability = neural_net(processed_observations, weights)
-    
-        episode_observations.append(processed_observations)
-        episode_hidden_layer_values.append(hidden_layer_values)
-
-        action = Move_up_or_down(up_probability)
-
-        # carry out the chosen action
-        observation, reward, done, info = env.step(action)
-
-        reward_sum += reward
-        episode_rewards.append(reward)
-
-        # see here: http://cs231n.github.io/neural-networks-2/#losses
-        fake_label = 1 if action == 2 else 0
-        loss_function_gradient = fake_label - up_probability
-        episode_gradient_log_ps.append(loss_function_gradient)
-
-
-        if done: # an episode finished
-            episode_number += 1
-
-            # Combine the following values for the episode
-            episode_hidden_layer_values = np.vstack(episode_hidden_layer_values)
-            episode_observations = np.vstack(episode_observations)
-            episode_gradient_log_ps = np.vstack(episode_gradient_log_ps)
-            episode_rewards = np.vstack(episode_rewards)
-
-            # Tweak the gradient of the log_ps based on the discounted rewards
-            episode_gradient_log_ps_discounted = discount_plus_rewards(episode_gradient_log_ps, episode_rewards, gamma)
-
-            gradient = compute_gradient(
-              episode_gradient_log_ps_discounted,
-              episode_hidden_layer_values,
-              episode_observations,
-              weights
-            )
-
-            # Sum the gradient for use when we hit the batch size
-            for layer_name in gradient:
-                g_dict[layer_name] += gradient[layer_name]
-
-            if episode_number % batch_size == 0:
-                weights_update(weights, expectation_g_squared, g_dict, decay_rate, learning_rate)
-
-            episode_hidden_layer_values, episode_observations, episode_gradient_log_ps, episode_rewards = [], [], [], [] # reset values
-            observation = env.reset() # reset env
-            running_reward = reward_sum if running_reward is None else running_reward * 0.99 + reward_sum * 0.01
-            print('resetting env. episode reward total was %f. running mean: %f' % (reward_sum, running_reward))
-            episodeData = {'episode_number': episode_number,'reward_sum': reward_sum, 'running_reward': running_reward}
-            saveEpisodeHistory(episodeData,historyFilename)
-            saveWeights(weights,weightsFilename)
-            config['episode_number'] = episode_number
-            config['reward_sum'] = reward_sum
-            config['running_reward'] = running_reward
-            config['prev_processed_observations'] = prev_processed_observations
-            saveTrainingConfig(config,configFilename)
-
-            reward_sum = 0
-            prev_processed_observations = None
-           
+    expectation_g_squared = checkpoint['expectation_g_squared']
+    g_dict = checkpoint['g_dict']
+
+    if (gradient_workers > 0): # episodes are played by worker processes instead, see trainWithWorkers
+        with MetricsWriter(historyFilename, maxRows=20, maxSeconds=60) as history:
+            trainWithWorkers(gradient_workers, config, configFilename, checkpointFilename, history, weights, expectation_g_squared, g_dict)
+        return
+
+    # num_envs envs are stepped in lockstep, so one matrix product picks all of their actions.
+    # Each keeps its own episode, which is learned from on its own when it ends
+    envs = [gym.make("Pong-v0") for i in range(num_envs)]
+    observations = [env.reset() for env in envs] # This gets us the images
+    prev_processed_observations = [config['prev_processed_observations']] + [None] * (num_envs - 1)
+    reward_sums = [reward_sum] + [0] * (num_envs - 1)
+
+    episodes = [EpisodeBuffer(input_dimensions, num_hidden_layer_neurons, sparse_observations) for i in range(num_envs)]
+
+    startTime = time.time()
+    episodesPlayed = 0
+    history = MetricsWriter(historyFilename, maxRows=20, maxSeconds=60)
+    try:
+        while True:
+            if(silent):
+                envs[0].render(mode='rgb_array')
+            else:
+                envs[0].render()
+            processed_observations = []
+            for i in range(num_envs):
+                processed_observation, prev_processed_observations[i] = preprocess_observations(observations[i], prev_processed_observations[i], input_dimensions)
+                processed_observations.append(processed_observation)
+            if sparse_observations:
+                processed_observations = [sparse_observation(observation) for observation in processed_observations]
+                hidden_layer_values, up_probabilities = neural_net_sparse(processed_observations, weights)
+            else:
+                hidden_layer_values, up_probabilities = neural_net(np.vstack(processed_observations), weights)
+
+            for i, env in enumerate(envs):
+                action = Move_up_or_down(up_probabilities[i])
+
+                # carry out the chosen action
+                observations[i], reward, done, info = env.step(action)
+
+                reward_sums[i] += reward
+
+                # see here: http://cs231n.github.io/neural-networks-2/#losses
+                fake_label = 1 if action == 2 else 0
+                loss_function_gradient = fake_label - up_probabilities[i]
+                episodes[i].append(processed_observations[i], hidden_layer_values[i], loss_function_gradient, reward)
+
+
+                if done: # an episode finished
+                    episode_number += 1
+                    episodesPlayed += 1
+                    reward_sum = reward_sums[i]
+
+                    start = time.time()
+                    gradient = episode_gradient(episodes[i], weights, gamma)
+                    gradientTime = time.time() - start
+                    episodeBytes = episodes[i].nbytes()
+
+                    # Sum the gradient for use when we hit the batch size
+                    for layer_name in gradient:
+                        g_dict[layer_name] += gradient[layer_name]
+
+                    if episode_number % batch_size == 0:
+                        weights_update(weights, expectation_g_squared, g_dict, decay_rate, learning_rate)
+
+                    episodes[i].clear() # reset values
+                    observations[i] = env.reset() # reset env
+                    running_reward = reward_sum if running_reward is None else running_reward * 0.99 + reward_sum * 0.01
+                    episodesPerHour = episodesPlayed / (time.time() - startTime) * 3600
+                    print('resetting env %d. episode reward total was %f. running mean: %f. %.1f episodes/hour with %d envs' % (i, reward_sum, running_reward, episodesPerHour, num_envs))
+                    print('episode took %.1f MB, gradient computed in %.0f ms' % (episodeBytes / 1e6, gradientTime * 1000))
+                    episodeData = {'episode_number': episode_number,'reward_sum': reward_sum, 'running_reward': running_reward}
+                    history.write(episodeData)
+                    start = time.time()
+                    saveCheckpoint({'weights': weights, 'expectation_g_squared': expectation_g_squared, 'g_dict': g_dict}, checkpointFilename)
+                    print('checkpoint saved in %.0f ms' % ((time.time() - start) * 1000))
+                    config['episode_number'] = episode_number
+                    config['reward_sum'] = reward_sum
+                    config['running_reward'] = running_reward
+                    config['prev_processed_observations'] = prev_processed_observations[i]
+                    saveTrainingConfig(config,configFilename)
+
+                    reward_sums[i] = 0
+                    prev_processed_observations[i] = None
+    finally:
+        history.close() # write the rows still held, also when interrupted
 
 
 if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'convert': # python main.py convert <sessionId>
+        sessionFolderpath = "./session_"+sys.argv[2]+"/"
+        convertJsonWeights(sessionFolderpath+"weights_"+sys.argv[2]+".json", sessionFolderpath+"checkpoint_"+sys.argv[2]+".bin")
+        sys.exit(0)
     try:
-        main()
+        if len(sys.argv) == 3 and sys.argv[1] == 'envs': # python main.py envs <N>, N envs in lockstep
+            main(numEnvs=int(sys.argv[2]))
+        elif len(sys.argv) == 3 and sys.argv[1] == 'workers': # python main.py workers <N>, N gradient worker processes
+            main(numWorkers=int(sys.argv[2]))
+        elif len(sys.argv) == 2 and sys.argv[1] == 'sparse': # python main.py sparse, see sparse_observation
+            main(sparse=True)
+        else:
+            main()
     except KeyboardInterrupt:
         print('Interrupted')
         try: